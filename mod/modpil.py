@@ -16,13 +16,91 @@
 #
 #
 
-import Image, ImageFile
+import Image
 import wx
 import math
 import struct
 import os
+import time
+import threading
 from numpy import *
-from numpy.fft import fft2
+from numpy.fft import rfft2, irfft2, fftfreq, rfftfreq
+from numpy.lib.stride_tricks import as_strided
+
+
+# --------------------------------------------------------------------
+# Image <-> numpy array bridge
+
+# numpy pixel type behind each single-band PIL mode
+modeDtype = {'F': dtype(float32), 'I': dtype(int32), 'L': dtype(uint8), 'P': dtype(uint8),
+		'I;16': dtype('<u2'), 'I;16L': dtype('<u2'), 'I;16B': dtype('>u2'),
+		'I;16S': dtype('<i2'), 'I;16BS': dtype('>i2')}
+
+def ArrayToImg(npa):
+	# Make a PIL image straight from a 2D array [y, x]: 'L' for uint8, otherwise 'F'
+	sizey, sizex = npa.shape
+	if npa.dtype == uint8:
+		npa = ascontiguousarray(npa)
+		return Image.frombuffer('L', (sizex, sizey), npa, 'raw', 'L', 0, 1)
+	npa = ascontiguousarray(npa, float32)
+	return Image.frombuffer('F', (sizex, sizey), npa, 'raw', 'F', 0, 1)
+
+def ImgSize(img):
+	# (sizex, sizey) of a PIL image or of a 2D array
+	if isinstance(img, ndarray):
+		return img.shape[1], img.shape[0]
+	return img.size
+
+def ImgToArray(img, dtype=float32):
+	# Wrap the pixel buffer of a grayscale image as a 2D array [y, x] (no per-pixel list)
+	# The array is read-only when it wraps the image buffer; dtype=None keeps the pixel type
+	if isinstance(img, ndarray):
+		npa = img
+	else:
+		if img.mode not in modeDtype:
+			img = img.convert('F')
+		sizex, sizey = img.size
+		npa = frombuffer(img.tobytes(), modeDtype[img.mode]).reshape(sizey, sizex)
+	if dtype is not None and npa.dtype != dtype:
+		npa = npa.astype(dtype)
+	return npa
+
+def ImgBytes(img):
+	# Memory taken by the pixels of a PIL image or an array (PIL keeps 3-band images in 4 bytes)
+	if isinstance(img, ndarray):
+		return img.nbytes
+	sizex, sizey = img.size
+	if img.mode in ('1', 'L', 'P'):
+		return sizex * sizey
+	if img.mode.startswith('I;16'):
+		return sizex * sizey * 2
+	return sizex * sizey * 4
+
+def GetPixel(img, x, y):
+	# Pixel value at (x, y) of a PIL image or array; IndexError outside of the image (as getpixel)
+	if isinstance(img, ndarray):
+		sizex, sizey = ImgSize(img)
+		if x < 0 or y < 0 or x >= sizex or y >= sizey:
+			raise IndexError, "image index out of range"
+		return img[y, x]
+	return img.getpixel((x, y))
+
+def Thumbnail(img, size):
+	# New PIL image shrunk (ANTIALIAS) to fit in size x size, from a PIL image or array;
+	# big arrays are block-averaged first, so only a small float copy is made
+	if isinstance(img, ndarray):
+		factor = max(1, max(img.shape) / (size * 2))
+		thn = ArrayToImg(BinArray(img, factor) if factor > 1 else img)
+	else:
+		thn = img.copy()
+	thn.thumbnail((size, size), Image.ANTIALIAS)
+	return thn
+
+def IsGray(img):
+	# True if every pixel is a single number (not a color tuple)
+	if isinstance(img, ndarray):
+		return img.ndim == 2
+	return len(img.getbands()) == 1
 
 
 def Brightness(img, factor):			# factor [-1,1]: 0: original pix; 1: all 255; -1: all 0
@@ -54,8 +132,103 @@ def Contrast_sigma(img, stat, sigma):
 	#print setmin, setmax
 	return Contrast(img, setmin, setmax, 0)
 
-def CountFrame(img):
+def ContrastWindow(pix_min, pix_max, brightness, invert, stat):
+	# Display window from min/max given on the shown (inverted if invert) pixel scale
+	# The inverted image is (2 * avg - pix), so its min/max map back around avg
+	if invert:
+		return [stat[0] * 2 - pix_max, stat[0] * 2 - pix_min, brightness, True]
+	return [pix_min, pix_max, brightness, False]
+
+def PercentileWindow(hist, low, high, brightness=0, invert=False):
+	# Display window from the low/high percentiles (0-1) of the shown (inverted if invert) image
+	if invert:				# Dark end of the inverted image is the bright end of the original
+		low, high = 1 - high, 1 - low
+	return [HistPercentile(hist, low), HistPercentile(hist, high), brightness, invert]
+
+def SigmaWindow(stat, sigma, invert=False):
+	# Display window of avg +/- sigma * std (same for the inverted image), no brightness adjustment
+	setmin = stat[0] - stat[1] * sigma
+	setmax = stat[0] + stat[1] * sigma
+	return [setmin, setmax, 0, invert]
+
+def Display(img, window):
+	# 8-bit ('L') display image of a grayscale image, window = [pix_min, pix_max, brightness, invert]
+	if not IsGray(img):
+		return img				# Color images are shown as they are
+	pix_min, pix_max, brightness, invert = window
+	return ArrayToImg(DisplayArray(ImgToArray(img, None), pix_min, pix_max, brightness, invert))
+
+def DisplayArray(npa, pix_min, pix_max, brightness=0, invert=False):
+	# Fused contrast/brightness/invert kernel: pixel array -> clipped uint8 display array
+	# pix_min..pix_max is stretched to 0..255 (255..0 if invert); done in row blocks that stay in cache
+	if pix_min == pix_max:
+		a = 1.0
+		b = 0.0
+	else:
+		a = 255.0 / (pix_max - pix_min)
+		b = brightness - pix_min * a
+	if invert:				# (pix_max - pix) * a + brightness
+		b = brightness + pix_max * a
+		a = -a
+	if npa.dtype.kind in 'iu' and npa.dtype.itemsize <= 2:
+		# 8/16-bit integers: one table lookup per pixel instead of the float kernel
+		lut = DisplayLut(npa.dtype, pix_min, pix_max, brightness, invert)
+		index = npa.view(npa.dtype.str.replace('i', 'u'))
+		sizey, sizex = npa.shape
+		out = empty((sizey, sizex), uint8)
+		rows = max(1, 65536 / max(1, sizex))	# take() widens the indices, so keep blocks in cache
+		for y in xrange(0, sizey, rows):
+			lut.take(index[y:y+rows], out=out[y:y+rows], mode='clip')
+		return out
+
+	sizey, sizex = npa.shape
+	out = empty((sizey, sizex), uint8)
+	rows = max(1, 65536 / max(1, sizex))	# 256 kB of float32 scratch per block
+	buf = empty((rows, sizex), float32)
+	for y in xrange(0, sizey, rows):
+		blk = buf[:min(rows, sizey - y)]
+		multiply(npa[y:y+rows], a, blk)
+		blk += b
+		clip(blk, 0, 255, blk)
+		out[y:y+rows] = blk
+	return out
+
+lutCache = {}		# {(dtype, pix_min, pix_max, brightness, invert): uint8 lookup table}
+
+def DisplayLut(dt, pix_min, pix_max, brightness=0, invert=False):
+	# uint8 table of DisplayArray over every value of a 8/16-bit integer type,
+	# indexed by the value's unsigned bit pattern (so int16 -1 is entry 65535)
+	key = (dt.str[1:], pix_min, pix_max, brightness, invert)
+	if key not in lutCache:
+		if len(lutCache) >= 32:			# 32 x 64 kB at most while contrast is being dragged
+			lutCache.clear()
+		nbits = dt.itemsize * 8
+		values = arange(1 << nbits, dtype='u%d' % dt.itemsize).view('%s%d' % (dt.kind, dt.itemsize))
+		lut = DisplayArray(values.astype(float32).reshape(1, -1), pix_min, pix_max, brightness, invert)[0]
+		lut.flags.writeable = False
+		lutCache[key] = lut
+	return lutCache[key]
+
+frameCountCache = {}	# {path: (mtime, size, count)} of files counted by seeking
+
+def CountFrame(img, path=None):
 	# Count how many images inside one stack file
+	# With the path, SPIDER/MRC counts come from the header (OpenStack) and other formats
+	# are counted once per path and mtime (img may then be None, it is opened when needed)
+	if path is not None:
+		stack = OpenStack(path)
+		if stack is not None:
+			return stack.nimages
+		st = os.stat(path)
+		if path in frameCountCache and frameCountCache[path][:2] == (st.st_mtime, st.st_size):
+			return frameCountCache[path][2]
+		if img is None:
+			img = Image.open(path)
+		count = CountFrame(img)
+		if len(frameCountCache) >= 64:
+			frameCountCache.clear()
+		frameCountCache[path] = (st.st_mtime, st.st_size, count)
+		return count
 	try:
 		nimages = img.nimages
 		return nimages
@@ -69,13 +242,100 @@ def CountFrame(img):
 		except EOFError:
 			return i
 
-def CutPartNormal(img, xylist, boxsize):
-	regionnormallist = []
-	regionlist = CutPart(img, xylist, boxsize)
-	for region in regionlist:
-		stat = StatCal(region)
-		regionnormallist.append(Contrast_sigma(region, stat, 3))
-	return regionnormallist
+def CutPartNormal(img, xylist, boxsize, sigma=3):
+	# Boxes around xylist as 'L' images, each shown at its own avg +/- sigma * std
+	# Boxes are cut and normalized in groups that fit in 1M pixels, the memory limit of one call
+	if not IsGray(img):
+		return CutPart(img, xylist, boxsize)	# Color images are shown as they are
+	if not isinstance(img, ndarray):
+		img = ImgToArray(img, None)
+	n, size = len(xylist), int(boxsize / 2.0) * 2
+	out = empty((n, size, size), uint8)
+	step = max(1, (1 << 20) / max(1, size * size))
+	for i in xrange(0, n, step):
+		parts = CutArray(img, xylist[i:i+step], boxsize)
+		blk = parts.reshape(-1, size * size).astype(float64)
+		avg = blk.mean(1)
+		blk -= avg[:, newaxis]
+		std = sqrt((blk * blk).mean(1))
+		pix_min = avg - std * sigma
+		a = where(std > 0, 255.0 / (std * sigma * 2 + (std == 0)), 1.0)
+		b = where(std > 0, -pix_min * a, 0.0)
+		# Same float32 arithmetic as DisplayArray, so each box matches Display(box, SigmaWindow)
+		disp = parts.reshape(-1, size * size).astype(float32)
+		disp *= a.astype(float32)[:, newaxis]
+		disp += b.astype(float32)[:, newaxis]
+		clip(disp, 0, 255, disp)
+		out[i:i+step] = disp.reshape(-1, size, size)
+	return [ArrayToImg(part) for part in out]
+
+def IntegralImage(img, offset=0.0):
+	# Summed-area tables [sum, sum of squares, offset] of (pix - offset), (h+1) x (w+1) float64
+	# with a zero first row/column; subtracting the image avg as offset keeps the box sums precise
+	npa = ImgToArray(img, None)
+	sizey, sizex = npa.shape
+	sat = zeros((sizey + 1, sizex + 1))
+	sat2 = zeros((sizey + 1, sizex + 1))
+	rows = max(1, 65536 / max(1, sizex))
+	for y in xrange(0, sizey, rows):
+		blk = npa[y:y+rows].astype(float64)
+		blk -= offset
+		for table, values in ((sat, blk), (sat2, blk * blk)):
+			part = table[y+1:y+1+len(blk), 1:]
+			cumsum(values, 1, out=part)		# Row sums, then down the block, then add the rows above
+			cumsum(part, 0, out=part)
+			part += table[y, 1:]
+	return [sat, sat2, offset]
+
+def BoxStat(integral, xylist, boxsize):
+	# avg and std arrays of the boxes around xylist, from the integral image (constant time per box)
+	# Only the part of a box inside the image is used
+	sat, sat2, offset = integral
+	sizey, sizex = sat.shape[0] - 1, sat.shape[1] - 1
+	rad = int(boxsize / 2.0)
+	xy = array(xylist, intp).reshape(-1, 2)
+	x0 = clip(xy[:, 0] - rad, 0, sizex)
+	x1 = clip(xy[:, 0] + rad, 0, sizex)
+	y0 = clip(xy[:, 1] - rad, 0, sizey)
+	y1 = clip(xy[:, 1] + rad, 0, sizey)
+	s = sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]
+	s2 = sat2[y1, x1] - sat2[y0, x1] - sat2[y1, x0] + sat2[y0, x0]
+	area = maximum((x1 - x0) * (y1 - y0), 1).astype(float64)
+	avg = s / area
+	std = sqrt(maximum(s2 / area - avg * avg, 0))
+	return avg + offset, std
+
+def CutArray(img, xylist, boxsize):
+	# All boxes around xylist as one [N, box, box] array (native type), 0 outside of the image (as PIL crop)
+	rad = int(boxsize / 2.0)
+	size = rad * 2
+	xy = array(xylist, intp).reshape(-1, 2) - rad	# Box corners
+	if not isinstance(img, ndarray):
+		img = ImgToArray(img, None)
+	sizey, sizex = img.shape
+	out = empty((len(xy), size, size), img.dtype)
+	inside = (xy >= 0).all(1) & (xy[:, 0] + size <= sizex) & (xy[:, 1] + size <= sizey)
+	if inside.any():
+		# [y, x, box, box] view of every box position in the image (no copy), then one gather
+		windows = as_strided(img, (sizey - size + 1, sizex - size + 1, size, size), img.strides * 2)
+		out[inside] = windows[xy[inside, 1], xy[inside, 0]]
+	for i in flatnonzero(~inside):			# Boxes over the edge, padded with 0
+		x0, y0 = xy[i]
+		out[i] = CropArray(img, (x0, y0, x0 + size, y0 + size))
+	return out
+
+def CropArray(img, box):
+	# Region box = (x0, y0, x1, y1) of an image as a 2D array, padded with 0 outside of the image
+	x0, y0, x1, y1 = box
+	if not isinstance(img, ndarray):
+		return ImgToArray(img.crop(box), None)
+	sizey, sizex = img.shape
+	region = zeros((y1 - y0, x1 - x0), img.dtype)
+	ya, yb = max(y0, 0), min(y1, sizey)
+	xa, xb = max(x0, 0), min(x1, sizex)
+	if ya < yb and xa < xb:
+		region[ya-y0:yb-y0, xa-x0:xb-x0] = img[ya:yb, xa:xb]
+	return region
 
 def CutPart(img, xylist, boxsize):
 	regionlist = []
@@ -87,80 +347,284 @@ def CutPart(img, xylist, boxsize):
 	return regionlist
 
 def Fft(img, tile):
-	# Calculate FFT of an image
+	# Calculate FFT of an image, averaging the power of half-overlapping tiles
+	return FftMask(FftPower(img, tile))
+
+def FftPower(img, tile):
+	# Log power (float32) of half-overlapping tiles, averaged and centered, not masked
 
-	imgx, imgy = img.size
+	imgx, imgy = ImgSize(img)
+	tile = FftSize(tile, min(imgx, imgy))
 	nx = int(imgx / tile) * 2 - 1	# all tiles overlap half
 	ny = int(imgy / tile) * 2 - 1
 	dis = int(tile / 2.0)
 
-	npa = array(img.getdata()).reshape(imgy, imgx)
-
-	powersum = zeros((tile, tile))	# Zeros array to store the sum
-	for ctx in xrange(nx):
-		for cty in xrange(ny):
-			x1 = dis * ctx
-			y1 = dis * cty
-			x2 = x1 + tile
-			y2 = y1 + tile
-			tilearray = npa[y1:y2,x1:x2]
-			fftimg = fft2(tilearray)
-			#tilepower = (fftimg.real)**2
-			tilepower = (abs(fftimg))**2
-			powersum += tilepower
+	npa = ImgToArray(img, None)			# Pixel type kept, rfft2 converts each batch
+	tiles = TileView(npa, tile, dis, nx, ny)	# [ny, nx, tile, tile] view, no copy
+
+	batch = max(1, (1 << 22) / (tile * tile))	# Tiles per stacked FFT, ~4M pixels (bounds the memory)
+	rowstep = max(1, batch / nx)
+	colstep = min(nx, batch)
+	powersum = zeros((tile, tile / 2 + 1))		# Zeros array to store the sum (half spectrum)
+	for cty in xrange(0, ny, rowstep):
+		for ctx in xrange(0, nx, colstep):
+			fftimg = rfft2(tiles[cty:cty+rowstep, ctx:ctx+colstep])	# FFT of these tiles at once
+			re, im = fftimg.real, fftimg.imag	# Power squared in place, no float64 temporaries
+			re *= re
+			im *= im
+			powersum += re.sum(axis=(0, 1))
+			powersum += im.sum(axis=(0, 1))
 	powersum = powersum / (nx * ny)	# Average power
 
-	tmpdata = []
-	for item in powersum.flat:
-		#powerdata.append(math.log(math.sqrt(item)*(1e-4) + 1))
-		tmpdata.append(math.log(item + 1))
+	powerdata = HalfToFull(log1p(powersum).astype(float32), tile)
+	return ShiftArray(powerdata, tile / 2, tile / 2)	# Assembly the 4 corners together
+
+def FftMask(power):
+	# Display image of a centered power spectrum (FftPower), its center and outer(corners) replaced
+	# with the average value; power itself is left as it is
+	tile = power.shape[0]
+	powerdata = power.copy()
+	pixavg = powerdata.mean(dtype=float64)
+	powerdata[FftCached(('mask', tile), RadialMask, tile, tile / 9.0)] = pixavg
+
+	return ArrayToImg(powerdata)
 
-	imgfft = Image.new("F", (tile, tile))
-	imgfft.putdata(tmpdata)
-	imgfft_center = ShiftImg(imgfft, dis, dis)		# Assembly the 4 corners together
 
-	# Replace the center and outer(corners) with average values
-	limit = (tile/9.0)**2
-	powerdata = array(imgfft_center.getdata()).reshape(tile, tile)
-	pixavg = average(powerdata)
-	for cx in range(tile):
-		for cy in range(tile):
-			if (cx-dis)**2 + (cy-dis)**2 <= limit:
-				powerdata[cx,cy] = pixavg
-	imgfft_center.putdata(powerdata.ravel())
+def ProfilePoints(profile, sizex, sizey):
+	# Line points [(x, y), ...] drawing a 1D profile scaled into a sizex x sizey box
+	npts = len(profile)
+	if npts < 2:
+		return []
+	pmin = profile.min()
+	prange = profile.max() - pmin
+	if prange <= 0:
+		prange = 1.0
+	xs = (arange(npts) * (sizex - 1.0) / (npts - 1)).astype(int)
+	ys = ((sizey - 1) - (profile - pmin) * (sizey - 1.0) / prange).astype(int)
+	return zip(xs.tolist(), ys.tolist())
 
-	return imgfft_center
+
+def RadialProfile(power):
+	# Rotationally averaged profile of a centered 2D spectrum, index = radius in pixels (to Nyquist)
+	sizey, sizex = power.shape
+	rad, count = FftCached(('radius', sizey, sizex), RadiusIndex, sizey, sizex)
+	return bincount(rad, ravel(power))[:len(count)] / count
+
+
+def RadiusIndex(sizey, sizex):
+	# Flat integer radius map of a centered sizey x sizex array, and the pixel count per radius
+	rmax = min(sizex, sizey) / 2
+	y, x = ogrid[-(sizey / 2):sizey-sizey/2, -(sizex / 2):sizex-sizex/2]
+	rad = sqrt(x*x + y*y).round().astype(intp).ravel()
+	rad[rad > rmax] = rmax + 1			# Beyond Nyquist (corners), dropped from the profile
+	count = bincount(rad)[:rmax + 1].astype(float64)
+	return rad, count
+
+
+def RadialMask(size, rad):
+	# Boolean disk of radius rad around the center (size/2, size/2) of a size x size array
+	cen = int(size / 2.0)
+	y, x = ogrid[-cen:size-cen, -cen:size-cen]
+	return x*x + y*y <= rad**2
+
+
+def TileView(npa, tile, dis, nx, ny):
+	# All nx*ny tiles (tile x tile, spaced by dis) of a 2D array as one strided [ny, nx, tile, tile] view
+	sy, sx = npa.strides
+	return as_strided(npa, (ny, nx, tile, tile), (sy * dis, sx * dis, sy, sx))
 
 
 def FftNotile(img, outsize):
 	# Calculate FFT of an image
 
-	imgx, imgy = img.size
-	minxy = min(imgx,imgy)
-	minxy = (int(minxy/2)) * 2
-	minxy_half = minxy / 2
-	imguse = img.crop((0, 0, minxy, minxy))
-	npa = array(imguse.getdata()).reshape(minxy, minxy)
-
-	fftimg = fft2(npa)
-	fftimg = abs(fftimg)
-	imgdata = []
-	for item in fftimg.flat:
-		imgdata.append((math.log(item))**2)
-	
-	imgfft = Image.new("F", (minxy, minxy))
-	imgfft.putdata(imgdata)
-	imgfft_center = ShiftImg(imgfft, minxy_half, minxy_half)	# Assembly the 4 corners together
+	imgx, imgy = ImgSize(img)
+	minxy = FftSize(min(imgx,imgy))		# Fast (2/3/5-smooth, even) square size
+	npa = FftFit(ImgToArray(img), minxy, minxy)
+
+	fftcenter = LogSpectrum(npa)		# Centered (log|F|)^2, 4 corners already assembled
+	return ArrayToImg(fftcenter).resize((outsize, outsize), Image.ANTIALIAS)
 
-	return imgfft_center.resize((outsize, outsize), Image.ANTIALIAS)
 
+def HalfToFull(half, nx):
+	# Rebuild the full (ny, nx) magnitude spectrum of a real image from its rfft2 half
+	# |F[y, x]| = |F[-y, -x]|, so the missing columns are mirrored from the half
+	ny, nh = half.shape
+	full = empty((ny, nx), half.dtype)
+	full[:, :nh] = half
+	if nx > nh:
+		rows, cols = FftCached(('mirror', ny, nx), MirrorIndex, ny, nx)
+		full[:, nh:] = half[rows, cols]
+	return full
+
+
+def MirrorIndex(ny, nx):
+	# Row/column indices of the rfft2 half that fill the missing columns (nh..nx-1)
+	rows = (-arange(ny)) % ny
+	cols = nx - arange(nx / 2 + 1, nx)
+	return rows[:, newaxis], cols
+
+
+def LogSpectrum(npa):
+	# (log|F|)^2 of a real 2D array, centered (zero frequency in the middle)
+	ny, nx = npa.shape
+	half = abs(rfft2(npa)).astype(float32)
+	maximum(half, finfo(float32).tiny, half)	# log(0) guard
+	log(half, half)
+	half *= half
+	return ShiftArray(HalfToFull(half, nx), nx / 2, ny / 2)
+
+
+# --------------------------------------------------------------------
+# FFT planning: fast transform sizes and per-size setup arrays
+
+fftCache = {}		# {(kind, size...): array}, reused by FFTs of same-shaped images
+
+def FftCached(key, func, *args):
+	# Setup array for 'key', made by func(*args) only the first time
+	if key not in fftCache:
+		if len(fftCache) >= 64:			# Keep the cache small
+			fftCache.clear()
+		value = func(*args)
+		for item in (value if isinstance(value, tuple) else (value,)):
+			item.flags.writeable = False	# Shared, so never modified in place
+		fftCache[key] = value
+	return fftCache[key]
+
+def FftFit(npa, ny, nx):
+	# Crop (top left) or pad (with the mean) a 2D array to ny x nx
+	sizey, sizex = npa.shape
+	if sizey >= ny and sizex >= nx:
+		return npa[:ny, :nx]
+	fit = empty((ny, nx), float32)
+	fit.fill(npa.mean(dtype=float64))
+	fit[:min(ny, sizey), :min(nx, sizex)] = npa[:ny, :nx]
+	return fit
+
+def FftSize(n, nmax=0):
+	# Nearest even 2/3/5-smooth length to n (cropping wins ties), for a fast FFT
+	# With nmax, never more than nmax (crop only)
+	key = ('size', n, nmax)
+	if key not in fftCache:
+		top = n
+		if nmax:
+			top = min(n, nmax)
+		lo = top - top % 2
+		while lo > 2 and not IsSmooth(lo):
+			lo -= 2
+		hi = n + n % 2
+		while not IsSmooth(hi):
+			hi += 2
+		if n - lo <= hi - n or (nmax and hi > nmax):
+			fftCache[key] = max(lo, 2)
+		else:
+			fftCache[key] = hi
+	return fftCache[key]
+
+def FftPadSize(n):
+	# Smallest even 2/3/5-smooth length >= n (padding only)
+	key = ('pad', n)
+	if key not in fftCache:
+		hi = max(2, n + n % 2)
+		while not IsSmooth(hi):
+			hi += 2
+		fftCache[key] = hi
+	return fftCache[key]
+
+def HalfSpectrum(img):
+	# [rfft2 (complex64) of a grayscale image padded with its mean to even 2/3/5-smooth sizes,
+	# sizey, sizex of the image]; computed once, then any number of filters reuse it (FilterArray)
+	npa = ImgToArray(img)
+	sizey, sizex = npa.shape
+	spec = rfft2(FftFit(npa, FftPadSize(sizey), FftPadSize(sizex))).astype(complex64)
+	return [spec, sizey, sizex]
+
+def FilterArray(halfspec, filt):
+	# Fourier-filtered image (float32) from HalfSpectrum, with one inverse FFT.
+	# filt = (kind, hp, lp), hp/lp in pixels: 'LP' low-pass at period lp, 'BP' band-pass keeping
+	# periods from lp to hp, 'GS' Gaussian blur of sigma lp; LP/BP edges are 8th-order Butterworth
+	spec, sizey, sizex = halfspec
+	ny, nx = spec.shape[0], (spec.shape[1] - 1) * 2
+	kind, hp, lp = filt
+	fy = fftfreq(ny).astype(float32)[:, newaxis]
+	fx = rfftfreq(nx).astype(float32)[newaxis, :]
+	f2 = fy * fy + fx * fx				# Squared spatial frequency (1/pixel)
+	if kind == 'GS':
+		weight = exp(f2 * float32(-2 * pi**2 * lp**2))
+	else:
+		weight = 1 / (1 + (f2 * float32(lp * lp))**4)
+		if kind == 'BP':
+			weight *= 1 - 1 / (1 + (f2 * float32(hp * hp))**4)
+	out = irfft2(spec * weight, (ny, nx))[:sizey, :sizex]
+	return ascontiguousarray(out, float32)
+
+def IsSmooth(n):
+	# True if n has no prime factor other than 2, 3 and 5
+	for p in (2, 3, 5):
+		while n % p == 0:
+			n /= p
+	return n == 1
+
+
+rgbScratch = {}		# {(sizex, sizey): RGB uint8 buffer} reused for gray -> RGB expansion
+
+def GrayToBmp(npa):
+	# wx.Bitmap from a uint8 grayscale array [y, x] with one buffer-based call
+	# (wx bitmaps are RGB, so the gray levels are expanded into a reused scratch buffer)
+	sizey, sizex = npa.shape
+	rgb = rgbScratch.get((sizex, sizey))
+	if rgb is None:
+		if len(rgbScratch) >= 16:		# Keep only a few sizes around
+			rgbScratch.clear()
+		rgb = empty((sizey, sizex, 3), uint8)
+		rgbScratch[(sizex, sizey)] = rgb
+	rgb[...] = npa[:, :, newaxis]
+	return wx.BitmapFromBuffer(sizex, sizey, rgb)	# Bitmap keeps its own copy
+
+def Histogram(img, stat, bins=4096):
+	# Fixed-bin histogram [counts, lo, width] of a grayscale image over stat min..max
+	npa = ImgToArray(img, None)
+	lo = float(stat[3])
+	width = 1.0
+	if stat[4] > stat[3]:
+		width = (stat[4] - lo) / bins
+	counts = zeros(bins, int64)
+	sizey, sizex = npa.shape
+	rows = max(1, (1 << 20) / max(1, sizex))
+	for y in xrange(0, sizey, rows):
+		idx = (npa[y:y+rows] - lo) * (1.0 / width)
+		clip(idx, 0, bins - 1, idx)
+		counts += bincount(idx.astype(uint16).ravel(), minlength=bins)	# bins <= 65536
+	return [counts, lo, width]
+
+def HistPercentile(hist, frac):
+	# Pixel value below which a fraction frac (0-1) of the pixels lie, interpolated in the bin
+	counts, lo, width = hist
+	cum = cumsum(counts)
+	target = frac * cum[-1]
+	i = min(searchsorted(cum, target), len(counts) - 1)
+	before = 0
+	if i > 0:
+		before = cum[i-1]
+	inbin = 0.0
+	if counts[i] > 0:
+		inbin = (target - before) / float(counts[i])
+	return lo + (i + inbin) * width
 
 def ImgToBmp(img):
-	image = wx.EmptyImage(img.size[0], img.size[1])
-#	image.SetData(img.convert('RGB').tostring())
-	image.SetData(img.convert('RGB').tobytes())
-	bmp = image.ConvertToBitmap()
-	return bmp
+	if IsGray(img):					# 8-bit gray buffer straight to the bitmap
+		if not isinstance(img, ndarray) and img.mode != 'L':
+			img = img.convert('L')
+		return GrayToBmp(ImgToArray(img, uint8))
+	if img.mode != 'RGB':
+		img = img.convert('RGB')
+	return wx.BitmapFromBuffer(img.size[0], img.size[1], img.tobytes())
+
+def StatInvert(stat):
+	# Stat of the inverted image (2 * avg - pix): avg, std and sum stay, min/max swap and mirror
+	if stat[3] > stat[4]:
+		return stat
+	avg, std, total, pix_min, pix_max = stat[:5]
+	return [avg, std, total, avg * 2 - pix_max, avg * 2 - pix_min]
 
 def InvertContrast(img, stat):
 	if stat[3] > stat[4]:
@@ -172,6 +636,56 @@ def InvertContrast(img, stat):
 	return img_invert
 	
 
+def BinImage(img, factor, fourier=False):
+	# Shrink an image (or array, giving a float32 array) by an integer factor:
+	# block mean, or Fourier crop if fourier (grayscale only)
+	if factor <= 1:
+		return img
+	if not IsGray(img):
+		sizex, sizey = img.size
+		return img.resize((max(1, sizex / factor), max(1, sizey / factor)), Image.ANTIALIAS)
+	npa = ImgToArray(img, None)
+	if fourier:
+		binned = FourierCrop(npa, factor)
+	else:
+		binned = BinArray(npa, factor)
+	if isinstance(img, ndarray):
+		return binned
+	return ArrayToImg(binned)
+
+def BinArray(npa, factor):
+	# Integer block mean (float32) of a 2D array; rows/columns left over at the end are dropped
+	# Sums of strided row slices, then of strided column slices (no float copy of the input)
+	sizey, sizex = npa.shape
+	ny, nx = sizey / factor, sizex / factor
+	out = zeros((ny, nx), float32)
+	rows = max(1, (1 << 20) / max(1, nx * factor * factor))	# Output rows per block of ~1M input pixels
+	acc = empty((rows, nx * factor), float32)
+	for y in xrange(0, ny, rows):
+		n = min(rows, ny - y)
+		blk = npa[y*factor:(y+n)*factor, :nx*factor]
+		rowsum = acc[:n]
+		rowsum[...] = blk[0::factor]
+		for k in xrange(1, factor):
+			rowsum += blk[k::factor]
+		for k in xrange(factor):
+			out[y:y+n] += rowsum[:, k::factor]
+	out *= 1.0 / (factor * factor)
+	return out
+
+def FourierCrop(npa, factor):
+	# Shrink a 2D array by cropping its spectrum to the low frequencies (float32, even output sizes):
+	# no aliasing, and the pixel values keep the same scale as the original
+	sizey, sizex = npa.shape
+	ny = max(2, sizey / factor / 2 * 2)
+	nx = max(2, sizex / factor / 2 * 2)
+	spec = rfft2(npa)
+	cropped = concatenate((spec[:ny/2, :nx/2+1], spec[sizey-ny/2:, :nx/2+1]))
+	del spec
+	out = irfft2(cropped, (ny, nx))
+	out *= float(ny * nx) / (sizey * sizex)
+	return out.astype(float32)
+
 def Resize(img, newsizex, newsizey):
 	sizex, sizey = img.size
 	if newsizex < sizex or newsizey < sizey:
@@ -191,24 +705,59 @@ def ResizeToBmp(img, newsizex, newsizey):
 	#image.Rescale(newsizex, newsizey)
 	#return wx.BitmapFromImage(image)
 
+def PyramidLevels(img, levels, minsize=64):
+	# 2x2 block means of a grayscale image, [level 1, level 2, ...] (float32) down to about minsize
+	# pixels; levels already in the list are kept and it is extended in place. None for color images
+	if not IsGray(img):
+		return levels
+	if len(levels) > 0:
+		npa = levels[-1]
+	else:
+		npa = ImgToArray(img, None)
+	while min(npa.shape) >= minsize * 2:
+		npa = BinArray(npa, 2)
+		levels.append(npa)
+	return levels
+
+def PyramidToBmp(img_contrast, img, levels, window, newsizex, newsizey):
+	# ResizeToBmp of img_contrast = Display(img, window) for zooming. Shrinking by 2x or more displays
+	# the smallest pyramid level of img (PyramidLevels) still covering the new size and resamples it,
+	# so the cost follows the bitmap size, not the image
+	sizex, sizey = img_contrast.size
+	if newsizex * 2 > sizex or newsizey * 2 > sizey:
+		return ResizeToBmp(img_contrast, newsizex, newsizey)
+	PyramidLevels(img, levels)
+	if len(levels) == 0:
+		return ResizeToBmp(img_contrast, newsizex, newsizey)
+	src = levels[0]
+	for level in levels[1:]:
+		if level.shape[1] < newsizex or level.shape[0] < newsizey:
+			break
+		src = level
+	return ResizeToBmp(Display(src, window), newsizex, newsizey)
+
 def ShiftImg(img, shx, shy):
-	# Shift an image by x-y integer numbers
-	imgsh = img.copy()
-	xsize, ysize = imgsh.size
-	nparray = array(imgsh.getdata()).reshape(ysize, xsize)
-	if shx != 0:
-		if shx < 0:
-			shx = xsize + shx
-		nparray = hstack((nparray[:,(xsize-shx):], nparray[:,:(xsize-shx)]))
-	if shy != 0:
-		if shy < 0:
-			shy = ysize + shy
-		nparray = vstack((nparray[(ysize-shy):,:], nparray[:(ysize-shy),:]))
-	imgsh.putdata(nparray.ravel())
-	return imgsh
+	# Shift an image by x-y integer numbers (circular)
+	return ArrayToImg(ShiftArray(ImgToArray(img, None), shx, shy))
+
+def ShiftArray(npa, shx, shy):
+	# Circular shift of a 2D array by x-y integer numbers (numpy roll semantics; fftshift is
+	# shx, shy = sizex / 2, sizey / 2), as four block copies into one new array of the same type
+	sizey, sizex = npa.shape
+	if sizex == 0 or sizey == 0:
+		return npa.copy()
+	shx %= sizex
+	shy %= sizey
+	restx, resty = sizex - shx, sizey - shy
+	out = empty_like(npa)
+	out[shy:, shx:] = npa[:resty, :restx]
+	out[shy:, :shx] = npa[:resty, restx:]
+	out[:shy, shx:] = npa[resty:, :restx]
+	out[:shy, :shx] = npa[resty:, restx:]
+	return out
 
 def Stat(filename):
-	# Get stat first by looking at the SPIDER header, if not found
+	# Get stat first by looking at the SPIDER or MRC header, if not found
 	# calculate them
 
 	hlist = SpiHeader(filename)
@@ -223,30 +772,257 @@ def Stat(filename):
 				imgmax = hdlist[7]
 				stat = [avg, std, sumlist, imgmin, imgmax]
 				return stat
-	img = Image.open(filename)
+	stat = MrcStat(MrcHeader(filename))
+	if len(stat) > 0:
+		return stat
+	img = OpenImage(filename)
 	return StatCal(img)
 
+# Real pixel modes: int8, int16, float32, uint16, float16, and 4-bit (two pixels per byte)
+mrcModeDtype = {0: 'i1', 1: 'i2', 2: 'f4', 6: 'u2', 12: 'f2', 101: 'u1'}
+imodStamp = 1146047817		# Header word 38 of files written by IMOD, word 39 are its flags
+
+def MrcSectionBytes(mode, nx, ny):
+	# Bytes of one nx x ny section; 4-bit rows are padded to whole bytes
+	if mode == 101:
+		return (nx + 1) / 2 * ny
+	return nx * ny * int(mrcModeDtype[mode][1])
 
-def StatCal(img):
+def MrcHeader(mrcfile):
+	# Get MRC header words 1-56 (index start=0: nx, ny, nz, mode ... dmin=19, dmax=20, dmean=21,
+	# nsymbt=23, 'MAP '=52, rms=54), or [] if the file does not look like an MRC file
+	return MrcHeaderEnd(mrcfile)[0]
+
+def MrcHeaderEnd(mrcfile):
+	# Get MRC header words 1-56 and the byte order ('<' or '>') they were read with
+	hlist = []
+	minsize = 1024
+	filesize = os.path.getsize(mrcfile)
+	if filesize < minsize:
+		return hlist, '<'
+
+	f = open(mrcfile, 'rb')
+	fh = f.read(56 * 4)
+	f.close()
+
+	for end in ('<', '>'):				# Little endian first (almost all files nowadays)
+		ints = struct.unpack(end + '56i', fh)
+		nx, ny, nz, mode = ints[:4]
+		if mode not in mrcModeDtype or nx <= 0 or ny <= 0 or nz <= 0 or ints[23] < 0:
+			continue
+		if 1024 + ints[23] + MrcSectionBytes(mode, nx, ny) * nz > filesize:
+			continue			# Data would not fit in the file
+		floats = struct.unpack(end + '56f', fh)
+		hlist = list(ints)
+		for i in (19, 20, 21, 54):		# Density stat words are floats
+			hlist[i] = floats[i]
+		hlist[52] = fh[208:212]
+		return hlist, end
+	return hlist, '<'
+
+class MrcStack:
+	# MRC image or stack file as a memory map; Frame(i) is section i (index start=0) as an
+	# [ny, nx] array of the file's pixel type, a zero-copy view for modes 0/1/2/6/12 in native
+	# byte order. Mode 0 is uint8 for IMOD files without the signed-bytes flag (int8 otherwise),
+	# mode 101 (4-bit, first pixel in the low 4 bits) is unpacked to uint8
+	def __init__(self, mrcfile):
+		hlist, end = MrcHeaderEnd(mrcfile)
+		if len(hlist) == 0:
+			raise IOError, "%s has no valid MRC header" % mrcfile
+		self.path = mrcfile
+		self.nx, self.ny, self.nimages, self.mode = hlist[:4]
+		code = mrcModeDtype[self.mode]
+		if self.mode == 0 and hlist[38] == imodStamp and not hlist[39] & 1:
+			code = 'u1'
+		if self.mode == 101:				# Packed rows: (nx + 1) / 2 bytes each
+			shape = (self.nimages, self.ny, (self.nx + 1) / 2)
+		else:
+			shape = (self.nimages, self.ny, self.nx)
+		self.data = memmap(mrcfile, dtype(end + code), 'r', 1024 + hlist[23], shape)
+
+	def Frame(self, i):
+		if i < 0 or i >= self.nimages:
+			raise EOFError, "%s has no image %d" % (self.path, i + 1)
+		frame = self.data[i]
+		if self.mode == 101:
+			unpacked = empty((self.ny, frame.shape[1] * 2), uint8)
+			bitwise_and(frame, 15, unpacked[:, 0::2])
+			right_shift(frame, 4, unpacked[:, 1::2])
+			return unpacked[:, :self.nx]
+		if not frame.dtype.isnative:
+			frame = frame.astype(frame.dtype.newbyteorder('='))	# Swap only the frames actually used
+		return frame
+
+def MrcStat(hlist):
+	# [avg, std, sum, min, max] from an MRC header, or [] if the header stat is not usable
+	if len(hlist) == 0 or hlist[2] != 1:		# Stacks/volumes: header stat is not of the first image
+		return []
+	if hlist[52] != 'MAP ':				# Old-style header, rms is not defined
+		return []
+	imgmin, imgmax, avg, std = hlist[19], hlist[20], hlist[21], hlist[54]
+	for value in (imgmin, imgmax, avg, std):
+		if value != value or abs(value) == float('inf'):	# NaN or inf
+			return []
+	# Unset values: dmax <= dmin, dmean outside dmin..dmax, rms <= 0 (often all 0 or -1)
+	if imgmax <= imgmin or avg < imgmin or avg > imgmax or std <= 0:
+		return []
+	return [avg, std, avg * hlist[0] * hlist[1], imgmin, imgmax]
+
+
+def StatCal(img, fast=False):
 	# Calculate the stat using numpy array
+	# Exact by default (StatStream); fast=True estimates avg/std from an evenly sampled subset
 
-	try:					# If color image: pixel value is a tuple, not a number
-		float(img.getpixel((0,0)))
-	except TypeError:			
+	if not IsGray(img):			# If color image: pixel value is a tuple, not a number
 		return [1, 1, 1, 1, -1]		# Mock values. stat[3](min) > stat[4](max) means 'color'
 
+	npa = ImgToArray(img, None)
+	if not fast:
+		return StatStream(npa)[0]
+
 	newsize = 512
-	sizex, sizey = img.size
-	if sizex > newsize and sizey > newsize:
-		imgs = img.copy()
-		imgs.thumbnail((newsize, newsize))
-		npa = array(imgs.getdata())
+	sizex, sizey = ImgSize(img)
+	if sizex > newsize and sizey > newsize:	# Quick avg/std from an evenly sampled subset
+		step = max(sizex, sizey) / newsize + 1
+		npas = npa[::step, ::step]
 	else:
-		npa = array(img.getdata())
-
-	imgmin, imgmax = img.getextrema()
-	return [average(npa), npa.std(), 0, imgmin, imgmax]	# [avg, std, dummy value, imgmin, imgmax]
-
+		npas = npa
+
+	imgmin, imgmax = float(npa.min()), float(npa.max())
+	return [npas.mean(dtype=float64), npas.std(dtype=float64), 0, imgmin, imgmax]	# [avg, std, dummy value, imgmin, imgmax]
+
+
+statThreads = 4		# Worker threads for StatStream
+
+def StatStream(npa, nthreads=0):
+	# Exact [avg, std, sum, min, max] of a 2D array in one pass over row blocks
+	# Blocks are reduced in float64 and merged pairwise (Welford/Chan), the sum is Kahan compensated
+	# Blocks are shared among nthreads worker threads (0: automatic); returns (stat, seconds)
+	t0 = time.time()
+	sizey, sizex = npa.shape
+	rows = max(1, (1 << 20) / max(1, sizex))	# ~1M pixels per block
+	blocks = range(0, sizey, rows)
+	parts = [None] * len(blocks)
+
+	def Reduce(ids):
+		for i in ids:
+			blk = npa[blocks[i]:blocks[i]+rows].astype(float64).ravel()
+			blkmin, blkmax = blk.min(), blk.max()
+			avg = blk.mean()
+			blk -= avg
+			parts[i] = (blk.size, avg, dot(blk, blk), blkmin, blkmax)
+
+	if nthreads == 0:
+		nthreads = statThreads
+	nthreads = max(1, min(nthreads, len(blocks)))
+	if nthreads == 1:
+		Reduce(range(len(blocks)))
+	else:
+		workers = []
+		for k in range(nthreads):
+			worker = threading.Thread(target=Reduce, args=(range(k, len(blocks), nthreads),))
+			worker.start()
+			workers.append(worker)
+		for worker in workers:
+			worker.join()
+
+	stat = StatMerge(parts)
+	return stat, time.time() - t0
+
+def StatMerge(parts):
+	# [avg, std, sum, min, max] from block parts (n, avg, m2, min, max), merged pairwise
+	# (Welford/Chan) with a Kahan compensated sum
+	n, avg, m2, imgmin, imgmax = parts[0]
+	total = n * avg
+	comp = 0.0
+	for nb, avgb, m2b, minb, maxb in parts[1:]:
+		nab = n + nb
+		delta = avgb - avg
+		avg += delta * nb / nab
+		m2 += m2b + delta * delta * n * nb / nab
+		n = nab
+		y = nb * avgb - comp			# Kahan summation of the block sums
+		t = total + y
+		comp = (t - total) - y
+		total = t
+		imgmin = min(imgmin, minb)
+		imgmax = max(imgmax, maxb)
+	return [avg, math.sqrt(m2 / n), total, imgmin, imgmax]
+
+def AnalyzeArray(npa, thumbsize=256, bins=4096):
+	# One streaming pass over row blocks of a 2D array, giving [stat, hist, thumbnail, level1]:
+	# the exact stat (as StatStream), a histogram [counts, lo, width] whose range grows with the
+	# data by merging bins, the thumbnail (PIL 'F', ANTIALIAS-fit in thumbsize) and the first
+	# pyramid level (2x2 block mean, float32). NaN/inf pixels are left out of the stat and histogram
+	sizey, sizex = npa.shape
+	tf = max(1, max(sizex, sizey) / (thumbsize * 2))	# Block mean before the PIL thumbnail
+	tf = max(1, min(tf, sizex, sizey))			# At least one thumbnail row/column
+	if tf % 2 == 1:					# Rows per block: multiple of 2 and tf
+		step = tf * 2
+	else:
+		step = tf
+	rows = max(1, (1 << 20) / max(1, sizex) / step) * step
+	parts = []
+	hist = None
+	level1 = empty((sizey / 2, sizex / 2), float32)
+	thumb = empty((sizey / tf, sizex / tf), float32)
+	for y in xrange(0, sizey, rows):
+		blk = npa[y:y+rows]
+		values = blk.astype(float64)
+		blkmin, blkmax = values.min(), values.max()
+		if not isfinite(blkmin + blkmax):		# NaN or inf in this block: finite pixels only
+			values = values[isfinite(values)]
+			if values.size > 0:
+				blkmin, blkmax = values.min(), values.max()
+		if values.size > 0:
+			hist = HistGrow(hist, blkmin, blkmax, bins)
+			counts, lo, width = hist
+			idx = values - lo
+			idx *= 1.0 / width
+			clip(idx, 0, bins - 1, idx)
+			counts += bincount(idx.astype(uint16).ravel(), minlength=bins)	# bins <= 65536
+			del idx
+			avg = values.mean()
+			values -= avg
+			values = values.ravel()
+			parts.append((values.size, avg, dot(values, values), blkmin, blkmax))
+		level1[y/2:(y+len(blk))/2] = BinArray(blk, 2)
+		if tf % 2 == 0:				# Thumbnail blocks from the level just made
+			thumb[y/tf:(y+len(blk))/tf] = BinArray(level1[y/2:(y+len(blk))/2], tf / 2)
+		else:
+			thumb[y/tf:(y+len(blk))/tf] = BinArray(blk, tf)
+	thn = ArrayToImg(thumb)
+	thn.thumbnail((thumbsize, thumbsize), Image.ANTIALIAS)
+	if len(parts) == 0:				# No finite pixel at all
+		return [[0.0, 0.0, 0.0, 0.0, 0.0], HistGrow(None, 0.0, 0.0, bins), thn, level1]
+	return [StatMerge(parts), hist, thn, level1]
+
+def HistGrow(hist, vmin, vmax, bins=4096):
+	# Histogram [counts, lo, width] (new one if hist is None) covering vmin..vmax: the range is
+	# moved down by whole bins and widened by merging bin pairs, so counts stay exact
+	if hist is None:
+		width = (vmax - vmin) / (bins - 1)
+		if width <= 0:
+			width = max(abs(vmin), 1.0) * 1e-6
+		return [zeros(bins, int64), vmin, width]
+	counts, lo, width = hist
+	used = flatnonzero(counts)
+	last = -1					# Last bin in use
+	if len(used) > 0:
+		last = used[-1]
+	while True:
+		shift = 0
+		if vmin < lo:
+			shift = int(math.ceil((lo - vmin) / width))
+		if last + shift < bins and int((vmax - lo) / width) + shift < bins:
+			break
+		counts = concatenate((counts.reshape(-1, 2).sum(1), zeros(bins / 2, int64)))
+		width *= 2
+		last /= 2
+	if shift > 0:
+		counts = concatenate((zeros(shift, int64), counts[:bins - shift]))
+		lo -= shift * width
+	return [counts, lo, width]
 
 def StatCal_bk100614(img):
 	#print '--- Calculating ...'
@@ -286,10 +1062,14 @@ def StatCal_bk100614(img):
 
 def SpiHeader(spiderfile):
 	# Get spider header records 1-30
+	return SpiHeaderEnd(spiderfile)[0]
+
+def SpiHeaderEnd(spiderfile):
+	# Get spider header records 1-30 and the byte order ('>' or '<') they were read with
 	hlist = []
 	minsize = 30 * 4
 	if os.path.getsize(spiderfile) < minsize:
-		return hlist
+		return hlist, '>'
 
 	f = open(spiderfile, 'rb')			# Open in binary mode
 	fh = f.read(minsize)
@@ -309,9 +1089,140 @@ def SpiHeader(spiderfile):
 		hlist = []
 		#print '%s has NO valid SPIDER header!' % spiderfile
 	#print endtype
-	return hlist
+	if endtype == 'BIG':
+		return hlist, '>'
+	return hlist, '<'
+
+# Header words (index start=1) of every image in a SPIDER file, as columns of SpiHeaderTable
+spiHeaderFields = [('NSLICE', 1), ('NROW', 2), ('IREC', 3), ('IFORM', 5), ('IMAMI', 6),
+		('FMAX', 7), ('FMIN', 8), ('AV', 9), ('SIG', 10), ('NSAM', 12), ('LABREC', 13),
+		('IANGLE', 14), ('PHI', 15), ('THETA', 16), ('PSI', 17), ('XOFF', 18), ('YOFF', 19),
+		('ZOFF', 20), ('SCALE', 21), ('LABBYT', 22), ('LENBYT', 23), ('INUSE', 24),
+		('MAXIM', 26), ('IMGNUM', 27)]
+
+def SpiHeaderTable(spiderfile):
+	# Headers of all images in a SPIDER file (stack or single image) as one structured array,
+	# columns named as in spiHeaderFields plus 'VALID'; row i is image i+1 of the stack.
+	# The per-image records are read in one strided pass over a memory map, no image data is read.
+	# Returns None if the file has no valid SPIDER header
+	hlist, end = SpiHeaderEnd(spiderfile)
+	if len(hlist) == 0:
+		return None
+	h = (99,) + hlist
+	labbyt = int(h[22])
+	datasize = int(h[12]) * int(h[2]) * int(h[1]) * 4
+	if h[24] > 0:					# Stack: overall header first, then header + data per image
+		offset = labbyt
+		nimg = int(h[26])
+	else:
+		offset = 0
+		nimg = 1
+	nimg = max(0, min(nimg, (os.path.getsize(spiderfile) - offset) / (labbyt + datasize)))
+
+	names = [name for name, word in spiHeaderFields]
+	table = zeros(nimg, dtype([(name, float32) for name in names] + [('VALID', bool)]))
+	if nimg == 0:
+		return table
+	record = dtype({'names': names, 'formats': [end + 'f4'] * len(names),
+		'offsets': [(word - 1) * 4 for name, word in spiHeaderFields], 'itemsize': labbyt + datasize})
+	mm = memmap(spiderfile, record, 'r', offset, (nimg,))
+	for name in names:
+		table[name] = mm[name]			# One column at a time, strided over the records
+	del mm
+
+	# Same tests as SpiTestIform, for all images at once, plus the stack image size
+	valid = ones(nimg, bool)
+	for name in ('NSLICE', 'NROW', 'IFORM', 'NSAM', 'LABREC', 'LABBYT', 'LENBYT'):
+		valid &= table[name] == floor(table[name])
+	valid &= table['LABBYT'] == table['LABREC'] * table['LENBYT']
+	valid &= (table['NSAM'] == h[12]) & (table['NROW'] == h[2])
+	table['VALID'] = valid
+	return table
 	
 
+class SpiderStack:
+	# SPIDER image or stack file as a memory map; Frame(i) is image i (index start=0) as a
+	# float32 [nrow, nsam] array, a zero-copy view unless the file byte order has to be swapped
+	def __init__(self, spiderfile):
+		hlist, self.end = SpiHeaderEnd(spiderfile)
+		if len(hlist) == 0:
+			raise IOError, "%s has no valid SPIDER header" % spiderfile
+		h = (99,) + hlist
+		if int(h[5]) not in (1, 3):			# Real 2D image or volume (first slice is used)
+			raise IOError, "%s is not a real SPIDER image (IFORM=%d)" % (spiderfile, int(h[5]))
+		self.path = spiderfile
+		self.nsam, self.nrow, self.nslice = int(h[12]), int(h[2]), max(1, int(h[1]))
+		self.labbyt = int(h[22])
+		self.framebytes = self.labbyt + self.nsam * self.nrow * self.nslice * 4	# header + data
+		filesize = os.path.getsize(spiderfile)
+		if h[24] > 0:					# Stack: overall header, then header + data per image
+			self.first = self.labbyt * 2
+			self.nimages = int(h[26])
+		else:
+			self.first = self.labbyt
+			self.nimages = 1
+		self.nimages = max(0, min(self.nimages, (filesize - self.first + self.labbyt) / self.framebytes))
+		self.data = memmap(spiderfile, dtype(self.end + 'f4'), 'r')	# Words of the whole file
+
+	def Frame(self, i):
+		if i < 0 or i >= self.nimages:
+			raise EOFError, "%s has no image %d" % (self.path, i + 1)
+		start = (self.first + i * self.framebytes) / 4
+		frame = self.data[start:start + self.nrow * self.nsam].reshape(self.nrow, self.nsam)
+		if not frame.dtype.isnative:
+			frame = frame.astype(float32)		# Swap only the frames actually used
+		return frame
+
+stackCache = {}		# {path: (mtime, size, SpiderStack/MrcStack)}, so a stack is mapped once
+
+def OpenStack(path):
+	# Memory-mapped reader of a stack file (SpiderStack or MrcStack), or None for other formats
+	try:
+		st = os.stat(path)
+	except OSError:
+		return None
+	if path in stackCache and stackCache[path][:2] == (st.st_mtime, st.st_size):
+		return stackCache[path][2]
+	stack = None
+	for reader in (SpiderStack, MrcStack):
+		try:
+			stack = reader(path)
+			break
+		except (IOError, ValueError):
+			pass
+	if len(stackCache) >= 16:
+		stackCache.clear()
+	stackCache[path] = (st.st_mtime, st.st_size, stack)
+	return stack
+
+def OpenImage(path, frame=0):
+	# Open image 'frame' (index start=0) of an image/stack file as a PIL image;
+	# stacks with a native reader are not decoded by PIL, but their frame is copied into the
+	# image ('F' is not a mapped PIL mode); OpenArray keeps the mapped frame without a copy
+	stack = OpenStack(path)
+	if stack is not None:
+		return ArrayToImg(stack.Frame(frame))
+	img = Image.open(path)
+	if frame > 0:
+		img.seek(frame)
+	return img
+
+def OpenArray(path, frame=0):
+	# Open image 'frame' (index start=0) as a 2D array of the file's own pixel type (int8, uint8,
+	# int16, uint16 or float32; float16 becomes float32), zero-copy for memory-mapped stacks.
+	# Color images stay PIL images
+	stack = OpenStack(path)
+	if stack is not None:
+		npa = stack.Frame(frame)
+	else:
+		img = OpenImage(path, frame)
+		if not IsGray(img):
+			return img
+		npa = ImgToArray(img, None)
+	if npa.dtype == float16:
+		npa = npa.astype(float32)
+	return npa
+
 def SpiTestIform(hlist):
 	# Test if the list looks like a SPIDER header
 
@@ -327,7 +1238,7 @@ def SpiTestIform(hlist):
 	for item in [1,2,5,12,13,22,23]:		# All these should be intergers
 		if h[item] != int(h[item]):
 			valid = False
-	if int(h[23]) != int(h[13]) * int(h[22]):	# LENBYT = LABREC * LABBYT
+	if int(h[22]) != int(h[13]) * int(h[23]):	# LABBYT = LABREC * LENBYT
 		valid = False
 	return valid
 
@@ -335,99 +1246,59 @@ def SpiTestIform(hlist):
 # --------------------------------------------------------------------
 # For saving 2D stack images in Spider format
 
-def makeSpiderHeaderInStack(im, ct):
-    nsam,nrow = im.size
-    lenbyt = nsam * 4  # There are labrec records in the header
-    labrec = 1024 / lenbyt
-    if 1024%lenbyt != 0: labrec += 1
-    labbyt = labrec * lenbyt
-    hdr = []
-    nvalues = labbyt / 4
-    for i in range(nvalues):
-        hdr.append(0.0)
-
-    if len(hdr) < 23:
-        return []
-
-    # NB these are Fortran indices
-    hdr[1]  = 1.0           # nslice (=1 for an image)
-    hdr[2]  = float(nrow)   # number of rows per slice
-    hdr[5]  = 1.0           # iform for 2D image
-    hdr[12] = float(nsam)   # number of pixels per line
-    hdr[13] = float(labrec) # number of records in file header
-    hdr[22] = float(labbyt) # total number of bytes in header
-    hdr[23] = float(lenbyt) # record length in bytes
-    hdr[27] = ct	    # Numbering of current stacked image
-
-    # adjust for Fortran indexing
-    hdr = hdr[1:]
-    hdr.append(0.0)
-    # pack binary data into a string
-    hdrstr = []
-    for v in hdr:
-        hdrstr.append(struct.pack('f',v))
-    return hdrstr
-
-
-def makeSpiderHeaderOverall(im_stack):
-    nsam,nrow = im_stack[0].size
-    maxim = len(im_stack)
-
-    lenbyt = nsam * 4  # There are labrec records in the header
-    labrec = 1024 / lenbyt
-    if 1024%lenbyt != 0: labrec += 1
-    labbyt = labrec * lenbyt
-    hdr = []
-    nvalues = labbyt / 4
-    for i in range(nvalues):
-        hdr.append(0.0)
-
-    if len(hdr) < 23:
-        return []
-
-    # NB these are Fortran indices
-    hdr[1]  = 1.0           # nslice (=1 for an image)
-    hdr[2]  = float(nrow)   # number of rows per slice
-    hdr[5]  = 1.0           # iform for 2D image
-    hdr[12] = float(nsam)   # number of pixels per line
-    hdr[13] = float(labrec) # number of records in file header
-    hdr[22] = float(labbyt) # total number of bytes in header
-    hdr[23] = float(lenbyt) # record length in bytes
-    hdr[24] = maxim
-    hdr[26] = maxim
-
-    # adjust for Fortran indexing
-    hdr = hdr[1:]
-    hdr.append(0.0)
-    # pack binary data into a string
-    hdrstr = []
-    for v in hdr:
-        hdrstr.append(struct.pack('f',v))
-    return hdrstr
+def SpiderHeaderArray(nsam, nrow):
+	# float32 SPIDER header of a 2D image, word k (index start=1) at [k-1], labbyt bytes long
+	lenbyt = nsam * 4				# There are labrec records in the header
+	labrec = 1024 / lenbyt
+	if 1024 % lenbyt != 0:
+		labrec += 1
+	labbyt = labrec * lenbyt
+	hdr = zeros(labbyt / 4, float32)
+	hdr[1-1] = 1.0					# nslice (=1 for an image)
+	hdr[2-1] = nrow					# number of rows per slice
+	hdr[5-1] = 1.0					# iform for 2D image
+	hdr[12-1] = nsam				# number of pixels per line
+	hdr[13-1] = labrec				# number of records in file header
+	hdr[22-1] = labbyt				# total number of bytes in header
+	hdr[23-1] = lenbyt				# record length in bytes
+	return hdr
+
+class SpiderStackWriter:
+	# Write a SPIDER stack (native byte order) one image at a time, nothing is kept in memory.
+	# The overall header is written first and its MAXIM (words 24, 26) patched by Close()
+	def __init__(self, filename, nsam, nrow):
+		self.nsam, self.nrow = nsam, nrow
+		self.header = SpiderHeaderArray(nsam, nrow)
+		self.count = 0
+		try:
+			self.fp = open(filename, 'wb')
+		except:
+			raise IOError, "Unable to open %s for writing" % filename
+		self.header.tofile(self.fp)		# Overall header, MAXIM = 0 until closed
+
+	def Append(self, img):
+		# Add one image (PIL image or 2D array) of the stack size, as float32
+		npa = ascontiguousarray(ImgToArray(img), float32)
+		if npa.shape != (self.nrow, self.nsam):
+			raise IOError, "Image size %s differs from the stack size %s" % \
+				(str(npa.shape[::-1]), str((self.nsam, self.nrow)))
+		self.count += 1
+		hdr = self.header.copy()
+		hdr[27-1] = self.count			# Numbering of current stacked image
+		hdr.tofile(self.fp)
+		npa.tofile(self.fp)
+
+	def Close(self):
+		hdr = self.header.copy()
+		hdr[24-1] = self.count			# ISTACK, > 0 for a stack
+		hdr[26-1] = self.count			# MAXIM
+		self.fp.seek(0)
+		hdr.tofile(self.fp)
+		self.fp.close()
 
 def saveStack(imstack, filename):
-    hdr_stack = makeSpiderHeaderOverall(imstack)
-    if len(hdr_stack) < 256:
-        raise IOError, "Error creating Spider 2D stack header"
-    # write the SPIDER header
-    try:
-        fp = open(filename, 'wb')
-    except:
-        raise IOError, "Unable to open %s for writing" % filename
-    fp.writelines(hdr_stack)
-
-    rawmode = "F;32NF"  #32-bit native floating point
-    ct = 0
-    for im in imstack:
-	ct += 1		# numbering of stacked images
-	if im.mode[0] != "F":
-        	im = im.convert('F')
-	hdr = makeSpiderHeaderInStack(im, ct)	# h[27]=ct
-    	if len(hdr) < 256:
-        	raise IOError, "Error creating Spider header"
-	fp.writelines(hdr)
-	#ims = im.tostring()
-	#fp.write(ims)
-	ImageFile._save(im, fp, [("raw", (0,0)+im.size, 0, (rawmode,0,1))])
-    fp.close()
-
+	nsam, nrow = ImgSize(imstack[0])
+	writer = SpiderStackWriter(filename, nsam, nrow)
+	for im in imstack:
+		writer.Append(im)
+	writer.Close()
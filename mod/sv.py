@@ -26,18 +26,25 @@ import datetime
 class ImageFile:
 	def __init__(self, path):
 		self.path = path
-		self.img = Image.new('F',(0,0), None)		# initiate with a mock image
+		self.img = Image.new('F',(0,0), None)		# initiate with a mock image (Modes 1/2 load arrays of the file's pixel type)
 		self.preSize = [0,0]				# [for record only] Image size before loading (if different, > sizex/y_ori)
 		self.preExtrema = [0,0]				# [for record only] Image min,max before loading
 
-		self.img_invert = Image.new('F',(0,0), None)	# inverted version
 		self.thumbnail = Image.new('F',(0,0), None)	# thumbnail version
 		self.fft = Image.new('F',(0,0), None)		# FFT of the image
-
-		self.sizex_ori, self.sizey_ori = self.img.size
+		self.fftpower = None				# FFT power spectrum (array) behind self.fft, unmasked
+		self.fftprofile = None				# Rotationally averaged profile of self.fftpower
+		self.fftcomplex = None				# Half spectrum of self.img, for display filters (not self.fft, tiled)
+		self.filtered = {}				# {filter: [array, stat, hist]} of filtered self.img
+		self.integral = None				# Summed-area tables of self.img, for the Mode 1 probe
+		self.pyramid = []				# 2x2 block means of self.img for zooming: [level 1, level 2, ...]
+
+		self.sizex_ori, self.sizey_ori = modpil.ImgSize(self.img)
 		self.stat = []					# calculated when the image is loaded
-		self.stat_invert = []				# stat for inverted image
+		self.hist = []					# histogram [counts, lo, width], calculated with stat
+		self.stat_invert = []				# stat for inverted image (inverted only in display)
 		self.rotang = 0.0				# Image rotation angle
+		self.binFactor = 1				# img is the original binned by this factor
 		self.shown = False
 		self.shown_invert = False
 		self.xylist = []				# particle coordinates (SVCO_*.dat)
@@ -68,14 +75,63 @@ class ImageFile:
 			displistref.append([newx-rad, newy-rad, newsize, newsize])
 		return displistref
 
+	def CalStat(self):
+		# stat and histogram are calculated once, when the image is first loaded
+		if len(self.stat) == 0:
+			self.stat = modpil.Stat(self.path)
+			if self.stat[3] <= self.stat[4]:	# otherwise color images
+				self.hist = modpil.Histogram(self.img, self.stat)
+
+	def Integral(self):
+		# Integral image for the Mode 1 box probe (None for color images), built once while shown
+		if self.integral is None and len(self.stat) > 0 and self.stat[3] <= self.stat[4]:
+			self.integral = modpil.IntegralImage(self.img, self.stat[0])
+		return self.integral
+
+	def DropCaches(self):
+		# Free the arrays only kept while this file is shown, they are made again on use
+		self.integral = None
+		self.fftcomplex = None
+		self.filtered = {}
+		self.pyramid = []
+
+	def MemSize(self):
+		# [all bytes, pixel bytes, pixel bytes if kept as float32] held by this file
+		pixels = modpil.ImgBytes(self.img)
+		sizex, sizey = modpil.ImgSize(self.img)
+		total = pixels + modpil.ImgBytes(self.thumbnail) + modpil.ImgBytes(self.fft)
+		if self.fftpower is not None:
+			total += self.fftpower.nbytes
+		if len(self.hist) > 0:
+			total += self.hist[0].nbytes
+		if self.integral is not None:
+			total += self.integral[0].nbytes + self.integral[1].nbytes
+		if self.fftcomplex is not None:
+			total += self.fftcomplex[0].nbytes
+		for item in self.filtered.values():
+			total += item[0].nbytes
+			for level in item[3]:
+				total += level.nbytes
+		for level in self.pyramid:
+			total += level.nbytes
+		return [total, pixels, sizex * sizey * 4]
+
+	def Filtered(self, filt):
+		# [array, stat, hist, pyramid] of self.img Fourier-filtered with filt = (kind, hp, lp) (modpil.FilterArray)
+		# The half spectrum is made once; each new filter costs one inverse FFT and is kept for reuse
+		if filt not in self.filtered:
+			if self.fftcomplex is None:
+				self.fftcomplex = modpil.HalfSpectrum(self.img)
+			if len(self.filtered) >= 4:		# Full-size arrays, keep only a few
+				self.filtered = {}
+			npa = modpil.FilterArray(self.fftcomplex, filt)
+			stat = modpil.StatCal(npa)
+			self.filtered[filt] = [npa, stat, modpil.Histogram(npa, stat), []]
+		return self.filtered[filt]
+
 	def InvertContrast(self):
-		self.img_invert = modpil.InvertContrast(self.img, self.stat)
-		#minmax = self.img_invert.getextrema()
-		#self.stat_invert = []
-		#self.stat_invert.extend(self.stat)
-		#self.stat_invert[3] = minmax[0]
-		#self.stat_invert[4] = minmax[1]
-		self.stat_invert = modpil.StatCal(self.img_invert)
+		# Inverted pixels (2 * avg - pix) are never stored, the display window does the inversion
+		self.stat_invert = modpil.StatInvert(self.stat)
 
 
 class ZoomBox:
@@ -113,6 +169,15 @@ class ZoomBox:
 		return pt_unzoom
 
 
+def MemInfo(imageFiles):
+	# Memory held by all open files; pixels are kept in the file's type, not as float32
+	mem = [0, 0, 0]
+	for imagefile in imageFiles:
+		mem = [a + b for a, b in zip(mem, imagefile.MemSize())]
+	return '%d files: %.0f MB (pixels %.0f MB, %.0f MB as float)' % \
+		(len(imageFiles), mem[0] / 1048576.0, mem[1] / 1048576.0, mem[2] / 1048576.0)
+
+
 # ========================================== #
 # ---------- Main SamViewer Classes -------- #
 # ========================================== #
@@ -309,6 +374,8 @@ class MainPanelM1(wx.Panel):
 		#self.distanceList = []		# Distance lines ([[x1,y1,x2,y2],...])
 		self.distanceStart = False
 		self.distanceEnd = False
+		self.probeSize = 16		# Box size of the Shift+move pixel probe
+		self.filter = None		# Fourier display filter (kind, hp, lp), None: unfiltered
 
 		self.zoombox = ZoomBox(wx.EmptyBitmap(1,1), (0, 0))	# Initial Mock zoombox, not shown
 		self.zoombox.shown = False
@@ -390,28 +457,43 @@ class MainPanelM1(wx.Panel):
 		# Read image files
 		for path in paths_checked:
 			try:
-				img = Image.open(path)
-				preSize = img.size
-				preExtrema = img.getextrema()
-				sizex, sizey = img.size
-				sizel = 2048				# size limit
-				if sizex > sizel and sizey > sizel:	# Make a smaller "original image"
-					stinfo = 'Shrinking %s' % os.path.basename(path)
+				img = modpil.OpenArray(path)		# Pixel type of the file kept
+				preSize = modpil.ImgSize(img)
+				sizex, sizey = preSize
+				imagefile = ImageFile(path)			# Class constructed
+
+				stinfo = 'Analyzing %s' % os.path.basename(path)
+				self.GetParent().statusbar.SetStatusText(stinfo, 0)
+				if modpil.IsGray(img):			# One pass: stat, histogram, thumbnail, 2x bin
+					imagefile.stat, imagefile.hist, thn, level1 = modpil.AnalyzeArray(img, 256)
+					preExtrema = imagefile.stat[3:5]
+				else:					# Color images
+					preExtrema = img.getextrema()
+					thn = modpil.Thumbnail(img, 256)
+					level1 = None
+				thn_stat = modpil.StatCal(thn)
+				imagefile.thumbnail = modpil.Display(thn, modpil.SigmaWindow(thn_stat, 3))
+
+				binFactor, fourier = self.bin_values[self.com_bin.GetSelection()]
+				if binFactor == 0:			# Auto: bin to within the size limit
+					sizel = 2048			# size limit
+					binFactor = 1
+					if sizex > sizel and sizey > sizel:
+						binFactor = int(math.ceil(max(sizex, sizey) / float(sizel)))
+				if binFactor == 2 and not fourier and level1 is not None:
+					img = level1			# Same block mean, already made
+				elif binFactor > 1:			# Make a smaller "original image"
+					stinfo = 'Binning %s by %d' % (os.path.basename(path), binFactor)
 					self.GetParent().statusbar.SetStatusText(stinfo, 0)
-					img.thumbnail((sizel, sizel))		# Not using ANTIALIAS for speed
+					img = modpil.BinImage(img, binFactor, fourier)
+				if binFactor > 1 and level1 is not None:	# Binning lowers the noise: stat of the pixels shown
+					imagefile.stat, imagefile.hist = modpil.AnalyzeArray(img, 256)[:2]	# NaN-safe, as above
 
-				imagefile = ImageFile(path)			# Class constructed
 				imagefile.img = img
 				imagefile.preSize = preSize
 				imagefile.preExtrema = preExtrema
-
-				stinfo = 'Making thumbnail of %s' % os.path.basename(path)
-				self.GetParent().statusbar.SetStatusText(stinfo, 0)
-				thn = img.copy()
-				thn.thumbnail((256,256), Image.ANTIALIAS)		# img_thumbnail resized inplace!!
-				thn_stat = modpil.StatCal(thn)
-				imagefile.thumbnail = modpil.Contrast_sigma(thn, thn_stat, 3)
-				stinfo = 'Making thumbnail of %s ... Done!' % os.path.basename(path)
+				imagefile.binFactor = binFactor
+				stinfo = 'Analyzing %s ... Done!' % os.path.basename(path)
 				self.GetParent().statusbar.SetStatusText(stinfo, 0)
 
 
@@ -466,52 +548,30 @@ class MainPanelM1(wx.Panel):
 		self.GetParent().statusbar.SetStatusText(stinfo, 0)
 
 
-		# ----- Calculate stat, img_invert, fft (when requested) ----- #
+		# ----- Calculate stat, fft (when requested) ----- #
 
-		if len(self.curImageFile.stat) == 0:				# Image Stat not calculated yet
-			self.curImageFile.stat = modpil.Stat(self.curImageFile.path)
-
-		#if self.invertMarker == -1:
-		#	if self.curImageFile.img_invert.size[0] == 0:		# Inverted image not calculated yet
-		#		self.curImageFile.InvertContrast()
+		self.curImageFile.CalStat()					# Image Stat, if not calculated yet
+		for imagefile in self.imageFiles:
+			if imagefile is not self.curImageFile:
+				imagefile.DropCaches()
 
 		if self.showFft == 1:
 			if self.curImageFile.fft.size[0] == 0:			# FFT not calculated yet
-				minsize = min(self.curImageFile.img.size)		# Smaller one out of sizex/y
-				if minsize >= 512:
-					tile = 512
-				elif minsize >= 256:
-					tile = 256
-				elif minsize >= 128:
-					tile = 128
-				elif minsize >= 64:
-					tile = 64
-				else:
-					tile = 0					# No FFT, return a mock image
-				if tile != 0:
-					#fft = modpil.Fft(self.curImageFile.img, tile)		# use tile
-					fft = modpil.FftNotile(self.curImageFile.img, tile)	# no tile
-					fftstat = modpil.StatCal(fft)
-					self.curImageFile.fft = modpil.Contrast_sigma(fft, fftstat, 3)
-				else:
-					self.curImageFile.fft = Image.new("F", (64,64))	# Mock image
+				self.CalFft(self.curImageFile)
 
 
 		# ----- Show stat ----- #
 
 		self.img_ori = self.curImageFile.img
-		self.img_ori_invert = self.curImageFile.img_invert
-		self.sizex_ori, self.sizey_ori = self.img_ori.size
+		self.sizex_ori, self.sizey_ori = modpil.ImgSize(self.img_ori)
 		
-		#if self.invertMarker == 1:
-		self.imgstat = self.curImageFile.stat
-		#else:
-		#	self.imgstat = self.curImageFile.stat_invert
+		self.img_shown, self.imgstat, self.hist_shown, self.levels_shown = self.ShownImage()
 
 		if self.curImageFile.stat[3] <= self.curImageFile.stat[4]:	# otherwise color images
 			statusinfo = 'Min=%.1f, Max=%.1f, Avg=%.1f, Std=%.1f, Size=%s->%s' %\
-				(self.curImageFile.preExtrema[0], self.curImageFile.preExtrema[1],self.imgstat[0],self.imgstat[1], str(self.curImageFile.preSize), str(self.img_ori.size))
+				(self.curImageFile.preExtrema[0], self.curImageFile.preExtrema[1],self.imgstat[0],self.imgstat[1], str(self.curImageFile.preSize), str(modpil.ImgSize(self.img_ori)))
 			self.GetParent().statusbar.SetStatusText(statusinfo, 0)
+		self.GetParent().statusbar.SetStatusText(MemInfo(self.imageFiles), 2)
 
 
 		# ----- Prepare image for display ----- #
@@ -520,14 +580,12 @@ class MainPanelM1(wx.Panel):
 			self.FitWin()					# Set all initial settings(map, size, pos, mag)
 			self.firstfileopen = False
 		else:							# Using previous settings
-			if self.invertMarker == 1:
-				self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img, self.curImageFile.stat, self.sigmalevel)
-			else:
-				self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img_invert, self.curImageFile.stat_invert, self.sigmalevel)
+			self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+			self.img_contrast = modpil.Display(self.img_shown, self.window)
 
 			self.bitmap_sizex = int(float(self.sizex_ori) * self.mag)
 			self.bitmap_sizey = int(float(self.sizey_ori) * self.mag)
-			self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+			self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 
 		# ----- Showing changes -----#
@@ -565,7 +623,7 @@ class MainPanelM1(wx.Panel):
 		sizex, sizey = wx.Bitmap.GetSize(self.bitmap)		# Save old size for centering
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		winsizex, winsizey = self.panel.GetSize()
 		centerx = winsizex / 2
@@ -588,11 +646,9 @@ class MainPanelM1(wx.Panel):
 		self.spin_contrastmin.SetValue(fmin)
 		self.spin_contrastmax.SetValue(fmax)
 
-		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img_invert, self.imgstat, self.sigmalevel)
-		else:
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img, self.imgstat, self.sigmalevel)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.img_shown, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.panel.Refresh()		
 
 	def OnContrastApply(self, event):
@@ -605,11 +661,9 @@ class MainPanelM1(wx.Panel):
 		truemin = imgmin + imgrange * 0.001 * self.spin_contrastmin.GetValue()
 		truemax = imgmin + imgrange * 0.001 * self.spin_contrastmax.GetValue()
 		brightness = self.spin_bright.GetValue()
-		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast(self.curImageFile.img_invert, truemin, truemax, brightness)
-		else:
-			self.img_contrast = modpil.Contrast(self.curImageFile.img, truemin, truemax, brightness)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.ContrastWindow(truemin, truemax, brightness, self.invertMarker == -1, self.imgstat)
+		self.img_contrast = modpil.Display(self.img_shown, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.panel.Refresh()
 
 	def OnInvert(self, event):
@@ -617,22 +671,66 @@ class MainPanelM1(wx.Panel):
 			return
 
 		self.invertMarker = self.invertMarker * (-1)
+		self.img_shown, self.imgstat, self.hist_shown, self.levels_shown = self.ShownImage()
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.img_shown, self.window)
+
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
+		self.panel.Refresh()
+
+		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmalevel)		# Set the values of contrast min/max fields
+		self.spin_contrastmin.SetValue(fmin)
+		self.spin_contrastmax.SetValue(fmax)
+
+	def OnPercentile(self, event):
+		# Auto contrast from the 0.5% and 99.5% percentiles, read from the cached histogram
+		if len(self.imageFiles) == 0 or len(self.hist_shown) == 0:
+			return
+
+		brightness = self.spin_bright.GetValue()
+		self.window = modpil.PercentileWindow(self.hist_shown, 0.005, 0.995, brightness, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.img_shown, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
+		self.panel.Refresh()
+
+		truemin, truemax = self.window[0], self.window[1]	# Set the values of contrast min/max fields
 		if self.invertMarker == -1:
-			if self.curImageFile.img_invert.size[0] == 0:		# Inverted image not calculated yet
-				self.curImageFile.InvertContrast()
-			self.imgstat = self.curImageFile.stat_invert
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img_invert, self.imgstat, self.sigmalevel)
-		else:
-			self.imgstat = self.curImageFile.stat
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img, self.imgstat, self.sigmalevel)
+			truemin, truemax = self.imgstat[0] * 2 - self.window[1], self.imgstat[0] * 2 - self.window[0]
+		imgrange = self.imgstat[4] - self.imgstat[3]
+		if imgrange > 0:
+			self.spin_contrastmin.SetValue(int(1000 * (truemin - self.imgstat[3]) / imgrange))
+			self.spin_contrastmax.SetValue(int(1000 * (truemax - self.imgstat[3]) / imgrange))
+
+
+	def OnFilter(self, event):
+		# Fourier display filter; the image spectrum is reused, a new cutoff is one inverse FFT
+		self.filter = self.filter_values[event.GetSelection()]
+		if len(self.imageFiles) == 0:
+			return
 
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		stinfo = 'Filtering %s ...' % os.path.basename(self.curImageFile.path)
+		self.GetParent().statusbar.SetStatusText(stinfo, 0)
+		self.img_shown, self.imgstat, self.hist_shown, self.levels_shown = self.ShownImage()
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.img_shown, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.panel.Refresh()
+		self.GetParent().statusbar.SetStatusText(stinfo + ' Done!', 0)
+		self.GetParent().statusbar.SetStatusText(MemInfo(self.imageFiles), 2)
 
 		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmalevel)		# Set the values of contrast min/max fields
 		self.spin_contrastmin.SetValue(fmin)
 		self.spin_contrastmax.SetValue(fmax)
 
+	def ShownImage(self):
+		# [image, stat, hist, pyramid] to display: the loaded image or its filtered version, stat inverted if needed
+		imagefile = self.curImageFile
+		img, stat, hist, levels = imagefile.img, imagefile.stat, imagefile.hist, imagefile.pyramid
+		if self.filter is not None and stat[3] <= stat[4]:	# Not for color images
+			img, stat, hist, levels = imagefile.Filtered(self.filter)
+		if self.invertMarker == -1:
+			stat = modpil.StatInvert(stat)
+		return [img, stat, hist, levels]
 
 	def OnFft(self, event):
 		if len(self.imageFiles) == 0:
@@ -641,7 +739,7 @@ class MainPanelM1(wx.Panel):
 		self.showFft = self.showFft * (-1)
 		if self.showFft == 1:
 			if self.curImageFile.fft.size[0] == 0:			# FFT not calculated yet
-				self.curImageFile.fft = self.CalFft(self.curImageFile.img)
+				self.CalFft(self.curImageFile)
 		self.panel.Refresh()
 
 	def OnBuffer(self, event):
@@ -652,11 +750,10 @@ class MainPanelM1(wx.Panel):
 			stinfo = 'Buffering %s ... ' % os.path.basename(imageFile.path)
 			self.GetParent().statusbar.SetStatusText(stinfo, 0)
 
-			if len(imageFile.stat) == 0:				# Image Stat not calculated yet
-				imageFile.stat = modpil.Stat(imageFile.path)
+			imageFile.CalStat()					# Image Stat, if not calculated yet
 
 			if imageFile.fft.size[0] == 0:			# FFT not calculated yet
-				imageFile.fft = self.CalFft(imageFile.img)
+				self.CalFft(imageFile)
 
 		stinfo = 'Buffering ALL DONE!'
 		self.GetParent().statusbar.SetStatusText(stinfo, 0)
@@ -687,8 +784,10 @@ class MainPanelM1(wx.Panel):
 		self.img_contrast.resize((self.bitmap_sizex, self.bitmap_sizey), Image.ANTIALIAS).convert('RGB').save(fullpath)
 
 
-	def CalFft(self, img):
-		minsize = min(img.size)		# Smaller one out of sizex/y
+	def CalFft(self, imagefile):
+		# Set imagefile.fft (for display), and the power spectrum and its radial profile
+		img = imagefile.img
+		minsize = min(modpil.ImgSize(img))		# Smaller one out of sizex/y
 		if minsize >= 512:
 			tile = 512
 		elif minsize >= 256:
@@ -700,14 +799,16 @@ class MainPanelM1(wx.Panel):
 		else:
 			tile = 0					# No FFT, return a mock image
 		if tile != 0:
-			#fft = modpil.Fft(img, tile)		# use tile
-			fft = modpil.FftNotile(img, tile)	# no tile			
+			imagefile.fftpower = modpil.FftPower(img, tile)	# use tile
+			imagefile.fftprofile = modpil.RadialProfile(imagefile.fftpower)	# Before the center is masked
+			fft = modpil.FftMask(imagefile.fftpower)
+			#fft = modpil.FftNotile(img, tile)	# no tile
 			fftstat = modpil.StatCal(fft)
-			output_fft = modpil.Contrast_sigma(fft, fftstat, 3)
+			imagefile.fft = modpil.Display(fft, modpil.SigmaWindow(fftstat, 3))
 		else:
-			output_fft = Image.new("F", (64,64))	# Mock image
-
-		return output_fft
+			imagefile.fft = Image.new("F", (64,64))	# Mock image
+			imagefile.fftpower = None
+			imagefile.fftprofile = None
 
 
 
@@ -744,11 +845,22 @@ class MainPanelM1(wx.Panel):
 			# Draw FFT
 			fft = self.curImageFile.fft
 			fftsizex, fftsizey = fft.size
+			profile = self.curImageFile.fftprofile
+			if profile is not None:			# Radial power profile drawn right of the FFT
+				profx = fftsizex + 10
+				fftsizex = profx + fft.size[0]
 			drawbmp = wx.EmptyBitmap(fftsizex, fftsizey)
 			memDC.SelectObject(drawbmp)
 			memDC.Clear()
 			fftbmp = modpil.ImgToBmp(fft)
 			memDC.DrawBitmap(fftbmp, 0, 0)
+			if profile is not None:
+				proflines = modpil.ProfilePoints(profile[1:], fft.size[0], fft.size[1])
+				memDC.SetPen(wx.Pen(wx.WHITE, 1))
+				memDC.SetBrush(wx.Brush(wx.BLACK, wx.TRANSPARENT))
+				memDC.DrawRectangle(profx, 0, fft.size[0], fft.size[1])
+				memDC.SetPen(wx.Pen(wx.GREEN, 1))
+				memDC.DrawLines(proflines, profx, 0)
 
 		# Draw distance lines
 		if len(self.curImageFile.distanceList) > 0:
@@ -792,7 +904,8 @@ class MainPanelM1(wx.Panel):
 			self.distanceStartY = int((pt[1] - self.bitmap_y)/self.mag)
 			self.distanceStart = True	# This will remain True unless (Ctrl+Middle)
 			self.distanceEnd = False
-			stinfo = 'Distance starting [%d, %d]' % (self.distanceStartX, self.distanceStartY)
+			b = self.curImageFile.binFactor
+			stinfo = 'Distance starting [%d, %d]' % (self.distanceStartX*b, self.distanceStartY*b)
 			self.GetParent().statusbar.SetStatusText(stinfo, 2)
 
 		elif event.ShiftDown():			# Increase Mag (= wheel function)
@@ -820,9 +933,10 @@ class MainPanelM1(wx.Panel):
 			pt = event.GetPosition()
 			self.distanceEndX = int((pt[0] - self.bitmap_x)/self.mag)
 			self.distanceEndY = int((pt[1] - self.bitmap_y)/self.mag)
-			distance = math.sqrt((self.distanceEndX - self.distanceStartX)**2 + (self.distanceEndY - self.distanceStartY)**2)
+			b = self.curImageFile.binFactor			# Reported in pixels of the original image
+			distance = math.sqrt((self.distanceEndX - self.distanceStartX)**2 + (self.distanceEndY - self.distanceStartY)**2) * b
 			distanceShow = '%.1f' % distance
-			stinfo = 'Distance ending [%d, %d], %.2f pixels' % (self.distanceEndX, self.distanceEndY, distance)
+			stinfo = 'Distance ending [%d, %d], %.2f pixels' % (self.distanceEndX*b, self.distanceEndY*b, distance)
 			self.GetParent().statusbar.SetStatusText(stinfo, 2)
 
 			if self.distanceEnd:				# (modifying the end point) remove the last item before appending
@@ -873,8 +987,13 @@ class MainPanelM1(wx.Panel):
 			ptimgx = int((pt[0] - self.bitmap_x)/self.mag)
 			ptimgy = int((pt[1] - self.bitmap_y)/self.mag)
 			try:
-				pix = self.img_ori.getpixel((ptimgx, ptimgy))
-				stinfo = 'X:%d, Y:%d, Value:%.3f' % (ptimgx+1, ptimgy+1, pix)
+				pix = modpil.GetPixel(self.img_ori, ptimgx, ptimgy)
+				b = self.curImageFile.binFactor		# X/Y of the original (unbinned) image
+				stinfo = 'X:%d, Y:%d, Value:%.3f' % (ptimgx*b+b/2+1, ptimgy*b+b/2+1, pix)
+				integral = self.curImageFile.Integral()
+				if integral is not None:		# avg/std of the box around the pointer
+					avg, std = modpil.BoxStat(integral, [[ptimgx, ptimgy]], self.probeSize)
+					stinfo += ', Box%d Avg:%.3f, Std:%.3f' % (self.probeSize, avg[0], std[0])
 				self.GetParent().statusbar.SetStatusText(stinfo, 2)
 			except IndexError:
 				pass
@@ -905,7 +1024,7 @@ class MainPanelM1(wx.Panel):
 
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		# Position of the resized bitmap (Center with mouse or display center)
 		if event.ControlDown():
@@ -930,7 +1049,7 @@ class MainPanelM1(wx.Panel):
 		sizex, sizey = wx.Bitmap.GetSize(self.bitmap)
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		# Position of the resized bitmap (Center with mouse or display center)
 		winsizex, winsizey = self.panel.GetSize()
@@ -1130,11 +1249,9 @@ class MainPanelM1(wx.Panel):
 			self.bitmap_sizey = int(self.bitmap_sizex * (float(self.sizey_ori) / self.sizex_ori))
 		self.bitmap_x = int((winsizex - self.bitmap_sizex)/2.0)
 		self.bitmap_y = int((winsizey - self.bitmap_sizey)/2.0)
-		if self.invertMarker == 1:
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img, self.curImageFile.stat, self.sigmalevel)
-		else:
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img_invert, self.curImageFile.stat_invert, self.sigmalevel)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.img_shown, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.img_shown, self.levels_shown, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.mag = self.bitmap_sizex / float(self.sizex_ori)
 		self.GetParent().statusbar.SetStatusText('Mag= %.3f' % self.mag, 1)
 
@@ -1157,12 +1274,15 @@ class Panel0_M1(wx.Panel):
 		self.ID_BUTOPEN = 227
 		self.ID_BUTCLOSE = 229
 		self.ID_COMFILES = 231
+		self.ID_COMBIN = 232
 		self.ID_FITWIN = 233
 		self.ID_SIZE1 = 235
 		self.ID_COMSIGMA = 237
 		self.ID_CONTRASTAPPLY = 241
 		self.ID_INVERT = 242
+		self.ID_PERCENT = 244
 		self.ID_FFT = 250
+		self.ID_COMFILTER = 252
 		self.ID_BUFFER = 254
 		self.ID_SAVE = 260
 
@@ -1177,6 +1297,10 @@ class Panel0_M1(wx.Panel):
 		self.GetParent().but_open = wx.Button(self, self.ID_BUTOPEN, 'Open')
 		self.GetParent().but_close = wx.Button(self, self.ID_BUTCLOSE, 'Close->')
 		self.GetParent().com_files = wx.ComboBox(self, self.ID_COMFILES, size=(50, -1), choices=files_ch, style=wx.CB_READONLY)
+		bin_choices = ['BIN Auto', 'BIN 1', 'BIN 2', 'BIN 3', 'BIN 4', 'BIN 2 FT', 'BIN 4 FT']	# used by next Open
+		self.GetParent().bin_values = [(0, False), (1, False), (2, False), (3, False), (4, False), (2, True), (4, True)]
+		self.GetParent().com_bin = wx.ComboBox(self, self.ID_COMBIN, size=(30, -1), choices=bin_choices, style=wx.CB_READONLY)
+		self.GetParent().com_bin.SetSelection(0)
 		self.GetParent().but_fitwin = wx.Button(self, self.ID_FITWIN, 'FIT Win', size=(20, -1))
 		self.GetParent().text_size = wx.TextCtrl(self, -1, '1.0', size=(20,-1))
 		self.GetParent().but_size1 = wx.Button(self, self.ID_SIZE1, '->Mag', size=(20, -1))
@@ -1189,7 +1313,12 @@ class Panel0_M1(wx.Panel):
 		self.GetParent().but_contrastapply = wx.Button(self, self.ID_CONTRASTAPPLY, '->D<-', size=(20, -1))
 		self.GetParent().spin_bright = wx.SpinCtrl(self, -1, '0', size=(20, -1), min=-255, max=255)
 		self.GetParent().but_invert = wx.Button(self, self.ID_INVERT, 'INVT', size=(20, -1))
+		self.GetParent().but_percent = wx.Button(self, self.ID_PERCENT, 'PCT', size=(20, -1))
 		self.GetParent().but_fft = wx.Button(self, self.ID_FFT, 'FFT', size=(20, -1))
+		filter_choices = ['NO FILTER', 'LP 5px', 'LP 10px', 'LP 20px', 'BP 200-10px', 'BP 100-5px', 'GAUSS 2px', 'GAUSS 4px']
+		self.GetParent().filter_values = [None, ('LP', 0, 5), ('LP', 0, 10), ('LP', 0, 20), ('BP', 200, 10), ('BP', 100, 5), ('GS', 0, 2), ('GS', 0, 4)]
+		self.GetParent().com_filter = wx.ComboBox(self, self.ID_COMFILTER, size=(30, -1), choices=filter_choices, style=wx.CB_READONLY)
+		self.GetParent().com_filter.SetSelection(0)
 		self.GetParent().but_buffer = wx.Button(self, self.ID_BUFFER, 'BUFFER', size=(20, -1))
 		self.GetParent().but_save = wx.Button(self, self.ID_SAVE, 'SAVE SHOWN', size=(20, -1))
 		#self.GetParent().emptytxt = wx.StaticText(self, -1, '')
@@ -1203,6 +1332,7 @@ class Panel0_M1(wx.Panel):
 		sizer1.Add(self.GetParent().but_open, 2, wx.EXPAND)
 		sizer1.Add(self.GetParent().but_close, 2, wx.EXPAND)
 		sizer1.Add(self.GetParent().com_files, 8, wx.EXPAND)
+		sizer1.Add(self.GetParent().com_bin, 3, wx.EXPAND)
 		sizer2.Add(self.GetParent().but_fitwin, 2, wx.EXPAND)
 		sizer2.Add(self.GetParent().text_size, 1, wx.EXPAND)
 		sizer2.Add(self.GetParent().but_size1, 2, wx.EXPAND)
@@ -1212,7 +1342,9 @@ class Panel0_M1(wx.Panel):
 		sizer3.Add(self.GetParent().but_contrastapply, 2, wx.EXPAND)
 		sizer3.Add(self.GetParent().spin_bright, 1, wx.EXPAND)
 		sizer3.Add(self.GetParent().but_invert, 2, wx.EXPAND | wx.LEFT, 10)
+		sizer3.Add(self.GetParent().but_percent, 2, wx.EXPAND)
 		sizer4.Add(self.GetParent().but_fft, 1, wx.EXPAND)
+		sizer4.Add(self.GetParent().com_filter, 1, wx.EXPAND)
 		sizer4.Add(self.GetParent().but_buffer, 1, wx.EXPAND)
 		sizer4.Add(self.GetParent().but_save, 1, wx.EXPAND)
 		#sizer4.Add(self.GetParent().emptytxt, 1, wx.EXPAND)
@@ -1231,7 +1363,9 @@ class Panel0_M1(wx.Panel):
 		self.Bind(wx.EVT_COMBOBOX, self.GetParent().OnSigma, id = self.ID_COMSIGMA)
 		self.Bind(wx.EVT_BUTTON, self.GetParent().OnContrastApply, id = self.ID_CONTRASTAPPLY)
 		self.Bind(wx.EVT_BUTTON, self.GetParent().OnInvert, id = self.ID_INVERT)
+		self.Bind(wx.EVT_BUTTON, self.GetParent().OnPercentile, id = self.ID_PERCENT)
 		self.Bind(wx.EVT_BUTTON, self.GetParent().OnFft, id = self.ID_FFT)
+		self.Bind(wx.EVT_COMBOBOX, self.GetParent().OnFilter, id = self.ID_COMFILTER)
 		self.Bind(wx.EVT_BUTTON, self.GetParent().OnBuffer, id = self.ID_BUFFER)
 		self.Bind(wx.EVT_BUTTON, self.GetParent().OnSave, id = self.ID_SAVE)
 
@@ -1358,7 +1492,7 @@ class MainPanelM2(wx.Panel):
 		# Read image files
 		for path in paths_checked:
 			try:
-				img = Image.open(path)
+				img = modpil.OpenArray(path)			# Pixel type of the file kept
 				imagefile = ImageFile(path)				# Class constructed
 				imagefile.img = img
 				self.imageFiles.append(imagefile)
@@ -1430,21 +1564,24 @@ class MainPanelM2(wx.Panel):
 	def LoadImage(self):
 		self.invertMarker = 1		# Autoset the image contrast as original (non-inverted)
 
-		if len(self.curImageFile.stat) == 0:				# process the first time opened file
-			self.curImageFile.stat = modpil.Stat(self.curImageFile.path)
+		self.curImageFile.CalStat()					# process the first time opened file
+		for imagefile in self.imageFiles:
+			if imagefile is not self.curImageFile:
+				imagefile.DropCaches()
 
 		self.img_ori = self.curImageFile.img
-		self.img_ori_invert = self.curImageFile.img_invert
-		self.sizex_ori, self.sizey_ori = self.img_ori.size
+		self.sizex_ori, self.sizey_ori = modpil.ImgSize(self.img_ori)
 
 		#if self.invertMarker == 1:
 		self.imgstat = self.curImageFile.stat
 		#else:
 		#	self.imgstat = self.curImageFile.stat_invert
 
-		statusinfo = 'Min=%.1f, Max=%.1f, Avg=%.1f, Std=%.1f, Size=%s' % (self.imgstat[3], self.imgstat[4],self.imgstat[0],self.imgstat[1], self.img_ori.size)
+		statusinfo = 'Min=%.1f, Max=%.1f, Avg=%.1f, Std=%.1f, Size=%s' % (self.imgstat[3], self.imgstat[4],self.imgstat[0],self.imgstat[1], modpil.ImgSize(self.img_ori))
 		self.GetParent().statusbar.SetStatusText(statusinfo, 0)
-		self.img_contrast = modpil.Contrast_sigma(self.img_ori, self.imgstat, self.sigmalevel)
+		self.GetParent().statusbar.SetStatusText(MemInfo(self.imageFiles), 2)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel)
+		self.img_contrast = modpil.Display(self.img_ori, self.window)
 
 		if self.firstfileopen:
 			self.FitWin()					# Set all initial settings(map, size, pos, mag)
@@ -1452,7 +1589,7 @@ class MainPanelM2(wx.Panel):
 		else:							# Using previous settings
 			self.bitmap_sizex = int(float(self.sizex_ori) * self.mag)
 			self.bitmap_sizey = int(float(self.sizey_ori) * self.mag)
-			self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+			self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmalevel)		# Set the values of contrast min/max fields
 		self.spin_contrastmin.SetValue(fmin)
@@ -1540,7 +1677,7 @@ class MainPanelM2(wx.Panel):
 		sizex, sizey = wx.Bitmap.GetSize(self.bitmap)		# Save old size for centering
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		winsizex, winsizey = self.panel.GetSize()
 		centerx = winsizex / 2
@@ -1564,11 +1701,9 @@ class MainPanelM2(wx.Panel):
 		self.spin_contrastmin.SetValue(fmin)
 		self.spin_contrastmax.SetValue(fmax)
 
-		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img_invert, self.imgstat, self.sigmalevel)
-		else:
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img, self.imgstat, self.sigmalevel)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.curImageFile.img, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.panel.Refresh()		
 
 	def OnContrastApply(self, event):
@@ -1581,11 +1716,9 @@ class MainPanelM2(wx.Panel):
 		truemin = imgmin + imgrange * 0.001 * self.spin_contrastmin.GetValue()
 		truemax = imgmin + imgrange * 0.001 * self.spin_contrastmax.GetValue()
 		brightness = self.spin_bright.GetValue()
-		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast(self.curImageFile.img_invert, truemin, truemax, brightness)
-		else:
-			self.img_contrast = modpil.Contrast(self.curImageFile.img, truemin, truemax, brightness)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.ContrastWindow(truemin, truemax, brightness, self.invertMarker == -1, self.imgstat)
+		self.img_contrast = modpil.Display(self.curImageFile.img, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.panel.Refresh()
 
 	def OnInvert(self, event):
@@ -1594,15 +1727,15 @@ class MainPanelM2(wx.Panel):
 
 		self.invertMarker = self.invertMarker * (-1)
 		if self.invertMarker == -1:
-			if self.curImageFile.img_invert.size[0] == 0:		# Inverted image not calculated yet
+			if len(self.curImageFile.stat_invert) == 0:		# Inverted stat not calculated yet
 				self.curImageFile.InvertContrast()
 			self.imgstat = self.curImageFile.stat_invert
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img_invert, self.imgstat, self.sigmalevel)
 		else:
 			self.imgstat = self.curImageFile.stat
-			self.img_contrast = modpil.Contrast_sigma(self.curImageFile.img, self.imgstat, self.sigmalevel)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmalevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.curImageFile.img, self.window)
 
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.panel.Refresh()
 
 		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmalevel)		# Set the values of contrast min/max fields
@@ -1922,7 +2055,7 @@ class MainPanelM2(wx.Panel):
 
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		# Position of the resized bitmap (Center with mouse or display center)
 		if event.ControlDown():
@@ -2171,7 +2304,7 @@ class MainPanelM2(wx.Panel):
 			self.bitmap_sizey = int(self.bitmap_sizex * (float(self.sizey_ori) / self.sizex_ori))
 		self.bitmap_x = int((winsizex - self.bitmap_sizex)/2.0)
 		self.bitmap_y = int((winsizey - self.bitmap_sizey)/2.0)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.mag = self.bitmap_sizex / float(self.sizex_ori)
 		self.GetParent().statusbar.SetStatusText('Mag= %.3f' % self.mag, 1)
 
@@ -2186,7 +2319,7 @@ class MainPanelM2(wx.Panel):
 		self.bitmap_x = int((winsizex - self.bitmap_sizex)/2.0)		# Align the image to the center top
 		self.bitmap_y = 0
 		#self.bitmap_y = int((winsizey - self.bitmap_sizey)/2.0)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.curImageFile.img, self.curImageFile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.mag = self.bitmap_sizex / float(self.sizex_ori)
 		self.GetParent().statusbar.SetStatusText('Mag= %.3f' % self.mag, 1)
 
@@ -2382,8 +2515,7 @@ class MainPanelM3(wx.Panel):
 			self.dispFile = path
 			self.text_file.SetValue(path)
 
-			img = Image.open(path)
-			self.total = modpil.CountFrame(img)
+			self.total = modpil.CountFrame(None, path)
 			self.dispSelection = xrange(self.total)
 			if len(self.dispSelection) > 0:
 				self.dispCurSel = 0
@@ -2426,13 +2558,12 @@ class MainPanelM3(wx.Panel):
 		while self.dispCurSel < len(self.dispSelection):
 
 			if self.starnum == 0:	# Open image stack
-				img = Image.open(self.dispFile)
-				img.seek(self.dispSelection[self.dispCurSel])
+				img = modpil.OpenArray(self.dispFile, self.dispSelection[self.dispCurSel])
 			else:			# Open file set
 				curname = str(self.dispSelection[self.dispCurSel] + 1).zfill(self.starnum)
 				curpath = self.dispFile.replace('#'*self.starnum, curname)
-				img = Image.open(curpath)
-			sizex, sizey = img.size
+				img = modpil.OpenArray(curpath)
+			sizex, sizey = modpil.ImgSize(img)
 			newsizex = int(sizex * mag)
 			newsizey = int(sizey * mag)
 				
@@ -2455,12 +2586,11 @@ class MainPanelM3(wx.Panel):
 					self.panel.Refresh()						
 					return				# Stop if in the middle of a file
 
+			stat = modpil.StatCal(img)
 			if self.ch_contrast == -1:		# Original contrast
-				imgmin, imgmax = img.getextrema()
-				img_contrast = modpil.Contrast(img, imgmin, imgmax, 0)
+				img_contrast = modpil.Display(img, [stat[3], stat[4], 0, False])
 			else:					# Contrast 3 Sigma
-				stat = modpil.StatCal(img)
-				img_contrast = modpil.Contrast_sigma(img, stat, 3)
+				img_contrast = modpil.Display(img, modpil.SigmaWindow(stat, 3))
 			if mag == 1:
 				partbmp = modpil.ImgToBmp(img_contrast)
 			else:
@@ -2564,8 +2694,7 @@ class MainPanelM3(wx.Panel):
 				print '%s is NOT found!' % path
 				return
 			else:
-				img = Image.open(path)
-				self.total = modpil.CountFrame(img)
+				self.total = modpil.CountFrame(None, path)
 				if len(numlist) == 0:
 					numlist = range(1, self.total + 1)	# to compensate the following (item-1)
 
@@ -3556,7 +3685,7 @@ class MainPanelM4(wx.Panel):
 			plend.mag = plstart.mag
 			plend.bitmap_sizex = int(plend.mag * plend.sizex_ori)
 			plend.bitmap_sizey = int(plend.mag * plend.sizey_ori)
-			plend.bitmap = modpil.ResizeToBmp(plend.img_contrast, plend.bitmap_sizex, plend.bitmap_sizey)
+			plend.bitmap = modpil.PyramidToBmp(plend.img_contrast, plend.imagefile.img, plend.imagefile.pyramid, plend.window, plend.bitmap_sizex, plend.bitmap_sizey)
 
 		# 'The image point at the window center' of two panels fulfill the transform
 		# To calculate the transform, the image point must convert back to original size!
@@ -3596,17 +3725,16 @@ class MainPanelM4(wx.Panel):
 		# Rotate the image by rotang
 		if rotang == 0.0:
 			panel.imagefile.img = panel.img_ori
-			panel.imagefile.img_invert = panel.img_ori_invert
 		else:
 			panel.imagefile.img = panel.img_ori.rotate(rotang*(-1.0))
-			panel.imagefile.img_invert = panel.img_ori_invert.rotate(rotang*(-1.0))
+		panel.imagefile.pyramid = []		# Made again from the rotated image
 		if panel.invertMarker == -1:
-			panel.img_contrast = modpil.Contrast_sigma(panel.imagefile.img_invert, panel.imagefile.stat_invert, panel.sigmaLevel)
 			panel.imgstat = panel.imagefile.stat_invert
 		else:
-			panel.img_contrast = modpil.Contrast_sigma(panel.imagefile.img, panel.imagefile.stat, panel.sigmaLevel)
 			panel.imgstat = panel.imagefile.stat
-		panel.bitmap = modpil.ResizeToBmp(panel.img_contrast, panel.bitmap_sizex, panel.bitmap_sizey)
+		panel.window = modpil.SigmaWindow(panel.imgstat, panel.sigmaLevel, panel.invertMarker == -1)
+		panel.img_contrast = modpil.Display(panel.imagefile.img, panel.window)
+		panel.bitmap = modpil.PyramidToBmp(panel.img_contrast, panel.imagefile.img, panel.imagefile.pyramid, panel.window, panel.bitmap_sizex, panel.bitmap_sizey)
 
 		panel.Refresh()
 		self.SetStatus()
@@ -3991,10 +4119,9 @@ class Panel_M4(wx.Panel):
 		#---------- Notes about image formation in the panel ----------#
 		# When loading image:
 		#	self.img_ori = self.imagefile.img
-		#	self.img_ori_invert = self.imagefile.img_invert
-		# Prepare image by first rotation, and then invert:
-		#	self.img_ori -> rotate -> self.imagefile.img -> invert -> self.imagefile.img_invert
-		# Contrast applied with sigma or fine values, and then resize for real display:
+		# Prepare image by rotation:
+		#	self.img_ori -> rotate -> self.imagefile.img
+		# Contrast (inverted or not) applied with sigma or fine values, and then resize for real display:
 		#	-> self.imagefile.img_contrast -> resize -> self.imagefile.bitmap
 
 
@@ -4020,7 +4147,7 @@ class Panel_M4(wx.Panel):
 
 		# Read and load the image file
 		try:
-			img = Image.open(path)
+			img = modpil.OpenImage(path)
 			self.imagefile.img = img
 
 			basename = os.path.splitext(os.path.basename(path))
@@ -4047,18 +4174,20 @@ class Panel_M4(wx.Panel):
 	def LoadImage(self):
 		self.invertMarker = 1		# Autoset the image contrast as original (non-inverted)
 
-		self.imagefile.stat = modpil.Stat(self.imagefile.path)
-		self.imagefile.InvertContrast()			# Get inverted image and stat_invert
+		self.imagefile.stat = []				# New file in this panel: stat and histogram again
+		self.imagefile.pyramid = []
+		self.imagefile.CalStat()
+		self.imagefile.InvertContrast()			# Get stat_invert
 
 		self.img_ori = self.imagefile.img
-		self.img_ori_invert = self.imagefile.img_invert
 		self.sizex_ori, self.sizey_ori = self.img_ori.size
 		if self.invertMarker == 1:
 			self.imgstat = self.imagefile.stat
 		else:
 			self.imgstat = self.imagefile.stat_invert
 
-		self.img_contrast = modpil.Contrast_sigma(self.img_ori, self.imgstat, self.sigmaLevel)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmaLevel)
+		self.img_contrast = modpil.Display(self.img_ori, self.window)
 
 		if self.firstfileopen:
 			self.FitWin()					# Set all initial settings(map, size, pos, mag)
@@ -4066,7 +4195,7 @@ class Panel_M4(wx.Panel):
 		else:							# Using previous settings
 			self.bitmap_sizex = int(float(self.sizex_ori) * self.mag)
 			self.bitmap_sizey = int(float(self.sizey_ori) * self.mag)
-			self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+			self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmaLevel)		# Set the values of contrast min/max fields
 		self.GetParent().GetParent().spin_contrastmin.SetValue(fmin)
@@ -4088,7 +4217,7 @@ class Panel_M4(wx.Panel):
 			self.bitmap_sizey = int(self.bitmap_sizex * (float(self.sizey_ori) / self.sizex_ori))
 		self.bitmap_x = int((winsizex - self.bitmap_sizex)/2.0)
 		self.bitmap_y = int((winsizey - self.bitmap_sizey)/2.0)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.mag = self.bitmap_sizex / float(self.sizex_ori)
 		self.Refresh()
 		self.SetStatus()
@@ -4103,7 +4232,7 @@ class Panel_M4(wx.Panel):
 		sizex, sizey = wx.Bitmap.GetSize(self.bitmap)		# Save old size for centering
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		winsizex, winsizey = self.GetSize()
 		centerx = winsizex / 2
@@ -4120,12 +4249,12 @@ class Panel_M4(wx.Panel):
 		item = self.GetGrandParent().com_sigma.GetSelection()
 		self.sigmaLevel = self.GetGrandParent().sigma_values[item]
 		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast_sigma(self.imagefile.img_invert, self.imagefile.stat_invert, self.sigmaLevel)
 			self.imgstat = self.imagefile.stat_invert
 		else:
-			self.img_contrast = modpil.Contrast_sigma(self.imagefile.img, self.imagefile.stat, self.sigmaLevel)
 			self.imgstat = self.imagefile.stat
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmaLevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.imagefile.img, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.Refresh()
 
 		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmaLevel)
@@ -4152,32 +4281,25 @@ class Panel_M4(wx.Panel):
 		truemax = imgmin + imgrange * 0.001 * self.GetGrandParent().spin_contrastmax.GetValue()
 		brightness = self.GetGrandParent().spin_bright.GetValue()
 		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast(self.imagefile.img_invert, truemin, truemax, brightness)
 			self.imgstat = self.imagefile.stat_invert
 		else:
-			self.img_contrast = modpil.Contrast(self.imagefile.img, truemin, truemax, brightness)
 			self.imgstat = self.imagefile.stat
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.ContrastWindow(truemin, truemax, brightness, self.invertMarker == -1, self.imgstat)
+		self.img_contrast = modpil.Display(self.imagefile.img, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.Refresh()
 
 	def InvertApply(self):
 		self.invertMarker = self.invertMarker * (-1)
 
-		# Prepare img by first rotation, and then invert
-		if self.imagefile.rotang == 0.0:
-			self.imagefile.img = self.img_ori
-			self.imagefile.img_invert = self.img_ori_invert
-		else:
-			self.imagefile.img = self.img_ori.rotate(self.imagefile.rotang*(-1.0))
-			self.imagefile.img_invert = self.img_ori_invert.rotate(self.imagefile.rotang*(-1.0))
-
+		# imagefile.img is already rotated, inversion is done by the display window
 		if self.invertMarker == -1:
-			self.img_contrast = modpil.Contrast_sigma(self.imagefile.img_invert, self.imgstat, self.sigmaLevel)
 			self.imgstat = self.imagefile.stat_invert
 		else:
-			self.img_contrast = modpil.Contrast_sigma(self.imagefile.img, self.imgstat, self.sigmaLevel)
 			self.imgstat = self.imagefile.stat
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.window = modpil.SigmaWindow(self.imgstat, self.sigmaLevel, self.invertMarker == -1)
+		self.img_contrast = modpil.Display(self.imagefile.img, self.window)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 		self.Refresh()
 
 		fmin, fmax = self.AutoContrastValue(self.imgstat, self.sigmaLevel)
@@ -4445,7 +4567,7 @@ class Panel_M4(wx.Panel):
 
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		# Position of the resized bitmap (Center with mouse or display center)
 		if event.ControlDown():
@@ -4488,17 +4610,17 @@ class Panel_M4(wx.Panel):
 			stat = self.imgstat
 			truemin = stat[0] - stat[1] * self.sigmaLevel
 			truemax = stat[0] + stat[1] * self.sigmaLevel
-			self.img_contrast = modpil.Contrast(self.imagefile.img_invert, truemin, truemax, self.brightness)
 		else:
 			self.imgstat = self.imagefile.stat
 			stat = self.imgstat
 			truemin = stat[0] - stat[1] * self.sigmaLevel
 			truemax = stat[0] + stat[1] * self.sigmaLevel
-			self.img_contrast = modpil.Contrast(self.imagefile.img, truemin, truemax, self.brightness)
+		self.window = modpil.ContrastWindow(truemin, truemax, self.brightness, self.invertMarker == -1, stat)
+		self.img_contrast = modpil.Display(self.imagefile.img, self.window)
 
 		self.bitmap_sizex = int(self.mag * self.sizex_ori)
 		self.bitmap_sizey = int(self.mag * self.sizey_ori)
-		self.bitmap = modpil.ResizeToBmp(self.img_contrast, self.bitmap_sizex, self.bitmap_sizey)
+		self.bitmap = modpil.PyramidToBmp(self.img_contrast, self.imagefile.img, self.imagefile.pyramid, self.window, self.bitmap_sizex, self.bitmap_sizey)
 
 		winsizex, winsizey = self.GetSize()
 		centerx = winsizex / 2